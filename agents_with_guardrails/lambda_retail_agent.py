@@ -1,148 +1,2243 @@
-
+import atexit
+import concurrent.futures
+import difflib
 import json
-import boto3
+from collections import OrderedDict
+from contextlib import contextmanager
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import random
 import logging
 import os
+import re
+import shutil
+import signal
+import sys
+import threading
+import time
+import urllib.request
+import uuid
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-session = boto3.session.Session()
-region_name = session.region_name
+region_name = os.environ.get('AWS_REGION', os.environ.get('AWS_DEFAULT_REGION'))
 
-s3 = boto3.client('s3', region_name = region_name)
+#S3 client, created on first use by s3_client() so importing boto3 stays off the init critical path
+s3 = None
+s3_lock = threading.Lock()
 
 bucket = os.environ.get('BUCKET_NAME')  #Name of bucket with data file and OpenAPI file
+#Without a bucket the file at LOCAL_DB_PATH is the data itself and S3 is never called, e.g. when the
+#client runs the operations in-process for an agent whose action group returns control
 logger.info(f'bucket :::: {bucket} and region_name :::: {region_name}')
 db_name = 'demo_csbot_db' #Location of data file in S3
-local_db = '/tmp/csbot.db' #Location in Lambda /tmp folder where data file will be copied
+local_db = os.environ.get('LOCAL_DB_PATH', '/tmp/csbot.db') #Location in Lambda /tmp folder where data file will be copied
+#Seconds a validated local copy is trusted before the next conditional GET and journal listing (0 = revalidate
+#on every invocation). Within the window, reads may miss orders other instances placed, by at most this long;
+#orders are not affected, as a journal write on a stale copy loses its conditional put and is rebased first.
+db_revalidate_seconds = float(os.environ.get('DB_REVALIDATE_SECONDS', '2'))
+
+#Journal of order deltas: one small object per order under '<data file key>.journal/', replayed over the snapshot
+#Number of journal entries on top of the snapshot after which they are folded into a new snapshot, once the
+#order that reached it has returned its response
+journal_compact_threshold = int(os.environ.get('JOURNAL_COMPACT_THRESHOLD', '100'))
+#Number of journal entries a sync downloads in parallel
+journal_fetch_concurrency = int(os.environ.get('JOURNAL_FETCH_CONCURRENCY', '16'))
+#Number of times an order is rebased and retried when concurrent instances commit first
+max_commit_attempts = int(os.environ.get('MAX_COMMIT_ATTEMPTS', '8'))
+#Minimum age before a compacted journal entry is deleted; must exceed the longest time between a sync and an order
+#(Lambda timeout plus DB_REVALIDATE_SECONDS)
+journal_retention_seconds = float(os.environ.get('JOURNAL_RETENTION_SECONDS', '3600'))
+#SQLite page cache per connection (KiB) and memory-mapped I/O window (bytes)
+sqlite_cache_kib = int(os.environ.get('SQLITE_CACHE_KIB', '16384'))
+sqlite_mmap_bytes = int(os.environ.get('SQLITE_MMAP_BYTES', str(256 * 1024 * 1024)))
+
+
+#Multi-store mode: the store (tenant) of an invocation is the StoreID session attribute. It is set by the
+#application invoking the agent, not by the model, so a prompt cannot switch to another tenant's data.
+#Each store has its own data file and journal under stores/<StoreID>/ in the bucket, while the default
+#store keeps the original keys. Store files are kept in /tmp in least-recently-used order.
+default_store = os.environ.get('DEFAULT_STORE', 'default')
+store_dir = os.environ.get('STORE_DIR', os.path.join(os.path.dirname(local_db), 'stores'))
+#Space the store files may take in /tmp (default: 75% of the volume) and memory for open stores
+#(default: a quarter of the function memory); each open store is charged its two SQLite page caches
+store_tmp_budget_mb = (float(os.environ['STORE_TMP_BUDGET_MB']) if 'STORE_TMP_BUDGET_MB' in os.environ
+                       else shutil.disk_usage(os.path.dirname(local_db)).total * 0.75 / 2 ** 20)
+store_memory_budget_mb = float(os.environ.get('STORE_MEMORY_BUDGET_MB', int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '512')) / 4))
+#Stores synced during the init phase besides the default one: this list plus the most used stores
+#of the previous process in this execution environment
+store_prefetch = [store for store in os.environ.get('STORE_PREFETCH', '').split(',') if store]
+store_prefetch_hot = int(os.environ.get('STORE_PREFETCH_HOT', '2'))
+
+#Validate the local copy and open the read connection during the init phase instead of the first invocation
+prewarm = os.environ.get('PREWARM', 'false').lower() in ('1', 'true', 'yes')
+
+
+#Write-behind mode: orders are committed to the local copy and the response returns at once; a background
+#flusher appends everything committed within this many seconds as one journal entry (0 = orders are
+#appended to the journal before the response is returned)
+write_behind_seconds = float(os.environ.get('WRITE_BEHIND_SECONDS', '0'))
+#Ids of write-behind journal entries remembered in the data file, so a newer snapshot tells whether it
+#already holds an entry whose put outcome was unknown
+journal_applied_keep = int(os.environ.get('JOURNAL_APPLIED_KEEP', '1000'))
+
+#Fraction of invocations that emit a metric record (cold starts always do unless this is 0) and their namespace
+metrics_sample_rate = float(os.environ.get('METRICS_SAMPLE_RATE', '1'))
+metrics_namespace = os.environ.get('METRICS_NAMESPACE', 'RetailAgent')
+
+#Storage behind the customer, inventory and order operations: 'sqlite' (the S3 data file and its order
+#journal) or 'kv' (a key-value store with atomic inventory counters). The kv backend uses the DynamoDB
+#table KV_TABLE_NAME, seeded with seed_key_value_table() (python lambda_retail_agent.py seed-kv ...).
+#KV_TABLE_NAME=:memory: selects an in-process stand-in loaded from the S3 data file instead; it is for
+#tests and benchmarks only, as every execution environment would hold its own inventory and orders.
+storage_backend = os.environ.get('RETAIL_STORE_BACKEND', 'sqlite')
+if storage_backend not in ('sqlite', 'kv'):
+    raise ValueError(f'RETAIL_STORE_BACKEND must be sqlite or kv, not {storage_backend}')
+kv_table_name = os.environ.get('KV_TABLE_NAME')
+if storage_backend == 'kv' and not kv_table_name:
+    raise ValueError('RETAIL_STORE_BACKEND=kv needs KV_TABLE_NAME, the DynamoDB table holding the stores')
+in_memory_kv = kv_table_name == ':memory:'
+#Whether the S3 data files are used at all, i.e. prefetched and revalidated
+uses_snapshots = storage_backend == 'sqlite' or in_memory_kv
+
+
+#Counters and phase timings of one invocation, written to stdout as a CloudWatch embedded metric
+#format (EMF) record so CloudWatch Logs turns them into metrics per apiPath without any API calls.
+#Time spent in the init-phase prefetch is carried into the first (cold) invocation.
+class InvocationMetrics:
+    def __init__(self):
+        self.values = {}
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - begin) * 1000)
+
+    def emit(self, api_path, status_code, cold_start):
+        names = sorted(self.values)
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': metrics_namespace,
+                    'Dimensions': [['ApiPath'], ['ApiPath', 'ColdStart']],
+                    'Metrics': [{'Name': name, 'Unit': self.unit(name)} for name in names]
+                }]
+            },
+            'ApiPath': api_path,
+            'ColdStart': 'true' if cold_start else 'false',
+            'StatusCode': status_code,
+        }
+        record.update((name, round(self.values[name], 3)) for name in names)
+        print(json.dumps(record), flush=True)
+
+    def reset(self):
+        self.values = {}
+
+    @staticmethod
+    def unit(name):
+        if name.endswith('Time'):
+            return 'Milliseconds'
+        if name.endswith('Bytes'):
+            return 'Bytes'
+        return 'Count'
+
+
+metrics = InvocationMetrics()
+cold_start = True
+
+
+journal_fetch_pool = None
+journal_fetch_pool_lock = threading.Lock()
+
+
+#Returns the thread pool journal entries are downloaded with, creating it on first use
+def journal_fetcher():
+    global journal_fetch_pool
+    if journal_fetch_pool is None:
+        with journal_fetch_pool_lock:
+            if journal_fetch_pool is None:
+                journal_fetch_pool = concurrent.futures.ThreadPoolExecutor(journal_fetch_concurrency,
+                                                                           thread_name_prefix='journal-fetch')
+    return journal_fetch_pool
+
+
+#Returns the S3 client, importing boto3 and creating the client on first use
+def s3_client():
+    global s3
+    if s3 is None:
+        with s3_lock:
+            if s3 is None:
+                import boto3
+                client = boto3.client('s3', region_name=region_name)
+                check_conditional_writes(client)
+                s3 = client
+    return s3
+
+
+#The order journal and compaction depend on S3 conditional writes. An SDK older than botocore 1.35.68 does
+#not know the PutObject IfNoneMatch/IfMatch parameters and would reject every order with a
+#ParamValidationError, so fail on first use with the fix instead.
+def check_conditional_writes(client):
+    members = client.meta.service_model.operation_model('PutObject').input_shape.members
+    missing = [name for name in ('IfNoneMatch', 'IfMatch') if name not in members]
+    if missing:
+        import botocore
+        raise RuntimeError(f"botocore {botocore.__version__} does not support S3 PutObject {' and '.join(missing)}; "
+                           "package boto3/botocore 1.35.99 or later with the function (see requirements.txt)")
+
+
+#Returns the HTTP status and error code of a botocore ClientError, or (None, None) for any other error.
+#Matches on the response the error carries, so botocore.exceptions stays off the init path.
+def error_status(error):
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return None, None
+    return response.get('ResponseMetadata', {}).get('HTTPStatusCode'), response.get('Error', {}).get('Code')
+
+
+#Returns True when a conditional GET was answered with 304 Not Modified
+def is_not_modified(error):
+    status, code = error_status(error)
+    return status == 304 or code in ('304', 'NotModified')
+
+
+#Returns True when a conditional write lost against a concurrent write of the same object
+def is_precondition_failed(error):
+    status, code = error_status(error)
+    return status in (409, 412) or code in ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+#Raised when an order could not be committed because other instances kept winning the journal slot
+class CommitConflictError(Exception):
+    pass
+
+
+#Order aggregates maintained by apply_ops in the same transaction as the order rows, so the analytics
+#operations read a few rows however large OrderDetails grows. Created and backfilled by prepare_db.
+SQL_UPSERT_SHOE_STATS = ('INSERT INTO OrderStatsByShoe (ShoeID, BestFitActivity, Pairs, LastOrderDate) '
+                         'VALUES (?, (SELECT BestFitActivity from ShoeInventory where ShoeID = ?), ?, ?) '
+                         'ON CONFLICT (ShoeID) DO UPDATE SET Pairs = Pairs + excluded.Pairs, '
+                         'LastOrderDate = max(LastOrderDate, excluded.LastOrderDate)')
+SQL_UPSERT_CUSTOMER_STATS = ('INSERT INTO OrderStatsByCustomer (CustomerID, ShoeID, Pairs, FirstOrderDate, LastOrderDate) '
+                             'VALUES (?, ?, ?, ?, ?) ON CONFLICT (CustomerID, ShoeID) DO UPDATE SET '
+                             'Pairs = Pairs + excluded.Pairs, FirstOrderDate = min(FirstOrderDate, excluded.FirstOrderDate), '
+                             'LastOrderDate = max(LastOrderDate, excluded.LastOrderDate)')
+
+
+#Applies journal operations to an open transaction. Replay uses the same code path as the
+#order itself, so a replica that replays the journal ends up with the writer's rows. Stock was
+#checked by the writer; replay applies the quantities unconditionally so every copy converges.
+def apply_ops(cur, ops):
+    for op in ops:
+        if op['op'] == 'order':
+            quantity = op.get('Quantity', 1)
+            cur.execute('Update ShoeInventory set InvCount = InvCount - ? where ShoeID = ?', (quantity, op['ShoeID']))
+            #one OrderDetails row per pair, the table has no quantity column
+            cur.executemany('INSERT INTO OrderDetails (orderdate, shoeId, CustomerId) VALUES (?, ?, ?)',
+                            [(op['OrderDate'], op['ShoeID'], op['CustomerID'])] * quantity)
+            cur.execute(SQL_UPSERT_SHOE_STATS, (op['ShoeID'], op['ShoeID'], quantity, op['OrderDate']))
+            cur.execute(SQL_UPSERT_CUSTOMER_STATS,
+                        (op['CustomerID'], op['ShoeID'], quantity, op['OrderDate'], op['OrderDate']))
+        elif op['op'] == 'result':
+            pass #outcome of a cart order, only kept to answer retries
+        else:
+            raise ValueError(f'unknown journal operation {op["op"]}')
+
+
+#Raised by a sync when a store has no data file, lambda_handler answers it with a 404
+class StoreNotFound(LookupError):
+    pass
+
+
+#Local /tmp copy of the S3 data file plus the order journal on top of it. The ETag of the
+#snapshot is remembered (also in a sidecar file, so a re-imported module keeps it) and every
+#refresh is a conditional GET, so the snapshot is only transferred again when it really
+#changed. Orders are appended as journal objects instead of re-uploading the whole file;
+#the sequence number of the last applied entry is stored inside the database itself.
+#Writes go through one WAL-mode connection; reads use a separate read-only connection opened
+#with immutable=1 (no locking at all), which is reopened after the write path has changed the file.
+#With bucket None the local file is the data file itself and nothing is read from or written to S3.
+class DbSnapshot:
+    def __init__(self, bucket, key, local_path, revalidate_seconds=0, compact_threshold=100, max_commit_attempts=8,
+                 retention_seconds=3600, on_open=None, on_apply=None, write_behind_seconds=0, applied_keep=1000,
+                 on_compact_due=None):
+        self.bucket = bucket
+        self.key = key
+        self.journal_prefix = key + '.journal/'
+        self.local_path = local_path
+        self.state_path = local_path + '.etag'
+        self.revalidate_seconds = revalidate_seconds
+        self.compact_threshold = compact_threshold
+        self.max_commit_attempts = max_commit_attempts
+        self.retention_seconds = retention_seconds
+        self.write_behind_seconds = write_behind_seconds
+        self.applied_keep = applied_keep
+        self.lock = threading.RLock() #the write-behind flusher runs next to the invocations
+        self.flush_requested = threading.Event()
+        self.flusher_stopped = False
+        self.on_open = on_open #called with the snapshot and each newly opened connection, e.g. to build indexes
+        self.on_apply = on_apply #called with the snapshot and the journal operations of each local commit and replayed entry
+        self.on_compact_due = on_compact_due #called when the journal reached the compaction threshold, to run compact_if_due() later
+        self.compact_due = False
+        self.replayed_ids = [] #ids of journal entries replayed by the last sync, to spot our own lost acknowledgements
+        self.etag = None
+        self.snapshot_seq = 0 #journal sequence folded into the S3 snapshot we hold
+        self.seq = 0 #journal sequence applied to the local copy
+        self.conn = None
+        self.read_conn = None
+        self.wal_dirty = False #writes not yet checkpointed into the main file
+        self.version = 0 #bumped whenever the local data changes, keys the response caches
+        self.in_transaction = False #reads go to the write connection to see uncommitted batch changes
+        self.last_checked = None
+        self.last_synced = None #when the last sync finished
+        self.cache = {} #response caches of the handlers, valid for one version of this store
+        if os.path.exists(local_path) and os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as state_fp:
+                state = json.load(state_fp)
+            self.etag = state.get('etag')
+            self.snapshot_seq = state.get('seq', 0)
+
+    def journal_key(self, seq):
+        return f'{self.journal_prefix}{seq:012d}.json'
+
+    def journal_seq_of(self, key):
+        return int(key[len(self.journal_prefix):].split('.')[0])
+
+    #Brings the local copy up to date: conditional GET of the snapshot, then journal replay.
+    #With fresh_after, a sync another thread finished after that (monotonic) time counts as this one.
+    def sync(self, force=False, fresh_after=None):
+        now = time.monotonic()
+        if (not force and self.last_checked is not None
+                and now - self.last_checked < self.revalidate_seconds):
+            return
+        with self.lock:
+            if fresh_after is not None and self.last_synced is not None and self.last_synced >= fresh_after:
+                return
+            self.replayed_ids = []
+            self.refresh()
+            if not self.catch_up():
+                #the entries we need were compacted away, so a newer snapshot must exist
+                self.refresh()
+                if not self.catch_up():
+                    raise RuntimeError(f'journal for {self.key} has a gap after sequence {self.seq}')
+            self.last_checked = now
+            self.last_synced = time.monotonic()
+
+    #Conditional GET of the data file, returns True when a new copy was downloaded
+    def refresh(self):
+        if self.bucket is None:
+            if self.conn is None and not os.path.exists(self.local_path):
+                #sqlite3.connect() would create an empty file in its place
+                raise StoreNotFound(f'{self.local_path} does not exist')
+            self.connection()
+            return False
+        request = {'Bucket': self.bucket, 'Key': self.key}
+        if self.etag is not None and os.path.exists(self.local_path):
+            request['IfNoneMatch'] = self.etag
+        try:
+            with metrics.timer('S3ReadTime'):
+                obj = s3_client().get_object(**request)
+        except Exception as e:
+            if error_status(e)[1] == 'NoSuchKey':
+                raise StoreNotFound(f's3://{self.bucket}/{self.key} does not exist') from e
+            if not is_not_modified(e):
+                raise
+            logger.info(f'{self.key} not modified, reusing {self.local_path}')
+            self.connection()
+            return False
+
+        #download next to the live copy and swap it in, so an open connection never sees a partial file
+        download_path = self.local_path + '.download'
+        with metrics.timer('S3ReadTime'), open(download_path, 'wb') as db_fp:
+            for chunk in obj['Body'].iter_chunks(1024 * 1024):
+                db_fp.write(chunk)
+                metrics.add('DownloadBytes', len(chunk))
+        pending = self.pending_rows()
+        self.close()
+        os.replace(download_path, self.local_path)
+        self.connection()
+        self.set_state(obj['ETag'], self.seq)
+        if pending:
+            self.restore_pending(pending)
+        logger.info(f'Downloaded {self.key} with ETag {self.etag} at journal sequence {self.seq}')
+        return True
+
+    #Write-behind transactions not yet in the journal, read from the local copy about to be replaced
+    def pending_rows(self):
+        if self.conn is not None:
+            return self.conn.execute('SELECT Ops, FlushId, CreatedAt FROM JournalPending ORDER BY rowid').fetchall()
+        if not os.path.exists(self.local_path):
+            return []
+        conn = sqlite3.connect(self.local_path)
+        try:
+            return conn.execute('SELECT Ops, FlushId, CreatedAt FROM JournalPending ORDER BY rowid').fetchall()
+        except sqlite3.OperationalError:
+            return [] #written before write-behind existed
+        finally:
+            conn.close()
+
+    #Re-applies pending write-behind transactions on top of a newly downloaded snapshot, except those
+    #whose journal entry the snapshot already holds
+    def restore_pending(self, pending):
+        cur = self.conn.cursor()
+        for ops, flush_id, created_at in pending:
+            if flush_id is not None and cur.execute('SELECT 1 FROM JournalApplied WHERE Id = ?', (flush_id,)).fetchone():
+                continue
+            apply_ops(cur, json.loads(ops))
+            cur.execute('INSERT INTO JournalPending (Ops, FlushId, CreatedAt) VALUES (?, ?, ?)', (ops, flush_id, created_at))
+        self.commit()
+
+    #Replays journal entries newer than the local copy, returns False if the journal has a gap
+    def catch_up(self):
+        if self.bucket is None:
+            return True
+        keys = []
+        with metrics.timer('S3ReadTime'):
+            paginator = s3_client().get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.journal_prefix, StartAfter=self.journal_key(self.seq)):
+                keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        if not keys:
+            return True
+        if self.journal_seq_of(keys[0]) != self.seq + 1:
+            return False
+        try:
+            with metrics.timer('S3ReadTime'):
+                if len(keys) == 1:
+                    entries = [self.journal_entry(keys[0])]
+                else:
+                    entries = list(journal_fetcher().map(self.journal_entry, keys))
+        except Exception as e:
+            if error_status(e)[1] == 'NoSuchKey':
+                return False #compacted away while we were listing
+            raise
+        seq = self.seq
+        cur = self.conn.cursor()
+        flush_ids = {row[0] for row in cur.execute('SELECT DISTINCT FlushId FROM JournalPending WHERE FlushId IS NOT NULL')}
+        applied = []
+        for entry in entries:
+            if entry['seq'] != seq + 1:
+                self.conn.rollback()
+                return False
+            if entry.get('id') in flush_ids:
+                #our own write-behind entry whose acknowledgement was lost; it is already in the local copy
+                cur.execute('DELETE FROM JournalPending WHERE FlushId = ?', (entry['id'],))
+            else:
+                apply_ops(cur, entry['ops'])
+                applied.append(entry['ops'])
+            if entry.get('deferred'):
+                cur.execute('INSERT OR REPLACE INTO JournalApplied (Id, Seq) VALUES (?, ?)', (entry['id'], entry['seq']))
+            seq = entry['seq']
+            self.replayed_ids.append(entry.get('id'))
+        cur.execute('UPDATE JournalState SET Seq = ?', (seq,))
+        self.commit()
+        self.seq = seq
+        if self.on_apply is not None:
+            for ops in applied:
+                self.on_apply(self, ops)
+        metrics.add('JournalEntriesReplayed', len(entries))
+        logger.info(f'Replayed {len(entries)} journal entries up to sequence {self.seq}')
+        return True
+
+    def journal_entry(self, key):
+        return json.loads(s3_client().get_object(Bucket=self.bucket, Key=key)['Body'].read())
+
+    #Commits operations locally and appends them to the journal as one small object
+    def append(self, ops):
+        def work():
+            apply_ops(self.conn.cursor(), ops)
+            return ops, None
+        self.transaction(work)
+        return self.seq
+
+    #Runs work() inside one local write transaction and appends the journal operations it returns
+    #as a single entry. The entry is written with a conditional put on its sequence number; if another
+    #instance took that number first, the local transaction is rolled back, the other writes are
+    #replayed and work() runs again on the new state. Returns the result of work().
+    def transaction(self, work):
+        if self.bucket is None:
+            return self.commit_locally(work, pending=False)
+        if self.write_behind_seconds > 0:
+            return self.commit_locally(work)
+        with self.lock:
+            entry_id = uuid.uuid4().hex
+            for attempt in range(self.max_commit_attempts):
+                seq = self.seq + 1
+                self.connection()
+                self.in_transaction = True
+                try:
+                    with metrics.timer('SqlTime'):
+                        ops, result = work()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                finally:
+                    self.in_transaction = False
+                if not ops:
+                    self.conn.rollback()
+                    return result
+                cur = self.conn.cursor()
+                cur.execute('UPDATE JournalState SET Seq = ?', (seq,))
+                body = json.dumps({'seq': seq, 'id': entry_id, 'ops': ops}).encode('utf-8')
+                try:
+                    with metrics.timer('S3WriteTime'):
+                        s3_client().put_object(Bucket=self.bucket, Key=self.journal_key(seq), Body=body, IfNoneMatch='*')
+                except Exception as e:
+                    self.conn.rollback()
+                    if not is_precondition_failed(e):
+                        raise
+                    metrics.add('CommitConflicts', 1)
+                    logger.info(f'Journal sequence {seq} already taken, rebasing (attempt {attempt + 1})')
+                    time.sleep(random.uniform(0, 0.01 * 2 ** min(attempt, 6)))
+                    self.sync(force=True)
+                    if entry_id in self.replayed_ids:
+                        #our earlier put did land even though the call failed
+                        return result
+                    continue
+                self.commit()
+                self.seq = seq
+                if self.on_apply is not None:
+                    self.on_apply(self, ops)
+                self.request_compaction()
+                return result
+            raise CommitConflictError(f'could not commit to the journal of {self.key} after {self.max_commit_attempts} attempts')
+
+    #Write-behind counterpart of transaction(): work() is committed to the local copy together with a
+    #JournalPending row holding its operations and the flusher is woken. Nothing is sent to S3 here.
+    #Without pending, for a data file that only exists locally, nothing is left to flush either.
+    def commit_locally(self, work, pending=True):
+        with self.lock:
+            self.connection()
+            self.in_transaction = True
+            try:
+                with metrics.timer('SqlTime'):
+                    ops, result = work()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.in_transaction = False
+            if not ops:
+                self.conn.rollback()
+                return result
+            if pending:
+                self.conn.execute('INSERT INTO JournalPending (Ops, CreatedAt) VALUES (?, ?)', (json.dumps(ops), time.time()))
+            self.commit()
+            if self.on_apply is not None:
+                self.on_apply(self, ops)
+        if pending:
+            self.flush_requested.set()
+        return result
+
+    #Appends the write-behind transactions waiting in JournalPending to the journal as one entry, with
+    #the same conditional put and rebase as transaction(); replaying other entries on top of the pending
+    #ones is safe because orders commute. The rows are tagged with the entry id before the put, so if
+    #the put lands but its acknowledgement is lost, the replay of the entry (or the JournalApplied table
+    #of a newer snapshot) recognises them instead of applying them twice. Returns the number of
+    #transactions persisted.
+    def flush(self):
+        with self.lock:
+            if self.conn is None:
+                return 0
+            row = self.conn.execute('SELECT FlushId FROM JournalPending ORDER BY rowid LIMIT 1').fetchone()
+            if row is None:
+                return 0
+            entry_id = row[0]
+            if entry_id is None:
+                entry_id = uuid.uuid4().hex
+                self.conn.execute('UPDATE JournalPending SET FlushId = ? WHERE FlushId IS NULL', (entry_id,))
+                self.commit_state()
+            rows = self.conn.execute('SELECT Ops, CreatedAt FROM JournalPending WHERE FlushId = ? ORDER BY rowid',
+                                     (entry_id,)).fetchall()
+        ops = [op for row_ops, _ in rows for op in json.loads(row_ops)]
+        for attempt in range(self.max_commit_attempts):
+            with self.lock:
+                if not self.conn.execute('SELECT 1 FROM JournalPending WHERE FlushId = ?', (entry_id,)).fetchone():
+                    return len(rows) #a sync found the entry already in the journal
+                seq = self.seq + 1
+            body = json.dumps({'seq': seq, 'id': entry_id, 'deferred': True, 'ops': ops}).encode('utf-8')
+            try:
+                s3_client().put_object(Bucket=self.bucket, Key=self.journal_key(seq), Body=body, IfNoneMatch='*')
+            except Exception as e:
+                if not is_precondition_failed(e):
+                    raise
+                logger.info(f'Journal sequence {seq} already taken, rebasing pending orders (attempt {attempt + 1})')
+                time.sleep(random.uniform(0, 0.01 * 2 ** min(attempt, 6)))
+                self.sync(force=True)
+                continue
+            with self.lock:
+                if self.seq == seq - 1:
+                    self.conn.execute('DELETE FROM JournalPending WHERE FlushId = ?', (entry_id,))
+                    self.conn.execute('INSERT OR REPLACE INTO JournalApplied (Id, Seq) VALUES (?, ?)', (entry_id, seq))
+                    self.conn.execute('UPDATE JournalState SET Seq = ?', (seq,))
+                    self.commit_state()
+                    self.seq = seq
+                    self.request_compaction()
+            logger.info(f'Flushed {len(rows)} pending transactions at journal sequence {seq}, '
+                        f'oldest waited {time.time() - rows[0][1]:.3f}s')
+            return len(rows)
+        raise CommitConflictError(f'could not flush to the journal of {self.key} after {self.max_commit_attempts} attempts')
+
+    #Flushes until nothing is pending, e.g. before the execution environment is frozen or shut down
+    def flush_all(self):
+        while self.flush():
+            pass
+
+    #Background thread of write-behind mode: once a transaction is pending it lets more commit for up to
+    #write_behind_seconds, then flushes them together
+    def start_flusher(self):
+        def run():
+            while True:
+                self.flush_requested.wait()
+                time.sleep(self.write_behind_seconds)
+                self.flush_requested.clear()
+                if self.flusher_stopped:
+                    return
+                try:
+                    self.flush_all()
+                except Exception as e:
+                    logger.info(f'Flushing pending orders failed, will retry: {e}')
+                    self.flush_requested.set()
+        threading.Thread(target=run, name='flusher', daemon=True).start()
+
+    def stop_flusher(self):
+        self.flusher_stopped = True
+        self.flush_requested.set()
+
+    #Marks the store for compaction once the journal has reached the threshold. The upload of the whole file
+    #is left to compact_if_due(), which runs after the response, so the order that crossed the threshold
+    #does not wait for it.
+    def request_compaction(self):
+        if self.seq - self.snapshot_seq < self.compact_threshold:
+            return
+        self.compact_due = True
+        if self.on_compact_due is not None:
+            self.on_compact_due()
+        else:
+            self.compact_if_due()
+
+    def compact_if_due(self):
+        with self.lock:
+            if not self.compact_due or self.conn is None:
+                return
+            self.compact_due = False
+            if self.seq - self.snapshot_seq >= self.compact_threshold:
+                self.compact()
+
+    #Folds the journal into a new snapshot and deletes the entries the previous snapshot already held.
+    #Entries between the previous and the new snapshot are kept so replicas one snapshot behind can still replay.
+    #The snapshot is replaced only if it is still the one we loaded; otherwise another instance compacted first.
+    def compact(self):
+        if self.conn.execute('SELECT 1 FROM JournalPending LIMIT 1').fetchone():
+            return #the file holds orders the journal does not have yet
+        previous_seq = self.snapshot_seq
+        self.conn.execute('DELETE FROM JournalApplied WHERE Seq <= ?', (self.seq - self.applied_keep,))
+        self.commit_state()
+        request = {'Bucket': self.bucket, 'Key': self.key}
+        if self.etag is not None:
+            request['IfMatch'] = self.etag
+        self.checkpoint()
+        try:
+            with metrics.timer('S3WriteTime'), open(self.local_path, 'rb') as db_fp:
+                resp = s3_client().put_object(Body=db_fp, **request)
+        except Exception as e:
+            if not is_precondition_failed(e):
+                raise
+            logger.info(f'{self.key} was compacted by another instance, skipping')
+            return
+        self.set_state(resp['ETag'], self.seq)
+        logger.info(f'Compacted journal of {self.key} into snapshot at sequence {self.seq}')
+        #an entry is only deleted once it is older than the retention period: a writer that synced
+        #before the entry existed could otherwise recreate its key with the conditional put
+        stale = []
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.retention_seconds)
+        with metrics.timer('S3WriteTime'):
+            paginator = s3_client().get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.journal_prefix):
+                stale.extend({'Key': obj['Key']} for obj in page.get('Contents', [])
+                             if self.journal_seq_of(obj['Key']) <= previous_seq and obj['LastModified'] < cutoff)
+            for i in range(0, len(stale), 1000):
+                s3_client().delete_objects(Bucket=self.bucket, Delete={'Objects': stale[i:i + 1000], 'Quiet': True})
+
+    def set_state(self, etag, snapshot_seq):
+        self.etag = etag
+        self.snapshot_seq = snapshot_seq
+        with open(self.state_path, 'w') as state_fp:
+            json.dump({'etag': etag, 'seq': snapshot_seq}, state_fp)
+
+    #Runs PRAGMA quick_check on the local copy, replacing a damaged copy with a fresh download,
+    #and opens the read connection so the first read does not pay for it
+    def validate(self):
+        try:
+            result = self.connection().execute('PRAGMA quick_check').fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            result = str(e)
+        if result != 'ok':
+            if self.bucket is None:
+                raise RuntimeError(f'{self.local_path} failed quick_check ({result})')
+            logger.info(f'{self.local_path} failed quick_check ({result}), downloading a fresh copy')
+            self.close()
+            for path in (self.local_path, self.local_path + '-wal', self.local_path + '-shm', self.state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.etag = None
+            self.snapshot_seq = 0
+            self.sync(force=True)
+        self.reader()
+
+    #Returns the write connection, opening it on first use or after a new download
+    def connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.local_path, check_same_thread=False, cached_statements=256)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            #durability comes from the S3 journal, the local copy only needs to stay consistent
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(f'PRAGMA cache_size=-{sqlite_cache_kib}')
+            self.conn.execute(f'PRAGMA mmap_size={sqlite_mmap_bytes}')
+            #the WAL is only folded into the main file by checkpoint(), never behind the immutable reader's back
+            self.conn.execute('PRAGMA wal_autocheckpoint=0')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS JournalState (Seq INTEGER NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS JournalPending (Ops TEXT NOT NULL, FlushId TEXT, CreatedAt REAL NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS JournalApplied (Id TEXT PRIMARY KEY, Seq INTEGER NOT NULL)')
+            row = self.conn.execute('SELECT Seq FROM JournalState').fetchone()
+            if row is None:
+                self.conn.execute('INSERT INTO JournalState (Seq) VALUES (0)')
+            self.seq = row[0] if row is not None else 0
+            if self.on_open is not None:
+                self.on_open(self, self.conn)
+            self.commit()
+            if self.write_behind_seconds > 0 and self.conn.execute('SELECT 1 FROM JournalPending LIMIT 1').fetchone():
+                #left behind by an earlier process, e.g. one that was shut down before it could flush
+                self.flush_requested.set()
+        return self.conn
+
+    #Returns the read-only connection used by the read paths
+    def reader(self):
+        if self.read_conn is None:
+            self.connection()
+            #an immutable reader does not look at the WAL, so pending writes are folded into the file first
+            self.checkpoint()
+            uri = 'file:' + self.local_path + '?mode=ro&immutable=1'
+            self.read_conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+            self.read_conn.execute(f'PRAGMA cache_size=-{sqlite_cache_kib}')
+            self.read_conn.execute(f'PRAGMA mmap_size={sqlite_mmap_bytes}')
+        return self.read_conn
+
+    #Commits the write connection; the immutable reader no longer matches the file and is dropped
+    def commit(self):
+        self.conn.commit()
+        self.wal_dirty = True
+        self.version += 1
+        self.close_reader()
+
+    #Commits bookkeeping that does not change what the reads see, so the reader and caches stay valid
+    def commit_state(self):
+        self.conn.commit()
+        self.wal_dirty = True
+
+    def checkpoint(self):
+        if self.wal_dirty:
+            #the immutable reader must not see the main file change underneath it
+            self.close_reader()
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.wal_dirty = False
+
+    def close_reader(self):
+        if self.read_conn is not None:
+            self.read_conn.close()
+            self.read_conn = None
+
+    def close(self):
+        self.close_reader()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.wal_dirty = False
+        self.version += 1
+        self.cache = {}
+
+    #Bytes the local copy and its sidecar files take in /tmp
+    def disk_usage(self):
+        paths = (self.local_path, self.local_path + '-wal', self.local_path + '-shm', self.state_path)
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    #Closes the copy and deletes its files; the next sync downloads it again
+    def remove_files(self):
+        self.stop_flusher()
+        self.close()
+        for path in (self.local_path, self.local_path + '-wal', self.local_path + '-shm', self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.etag = None
+        self.snapshot_seq = 0
+        self.last_checked = None
+        self.last_synced = None
+
+
+#Maximum number of candidates returned when a customer name matches several customers
+customer_match_limit = int(os.environ.get('CUSTOMER_MATCH_LIMIT', '5'))
+#Least similarity (difflib ratio, 0..1, case insensitive) of a name to count as a fuzzy match, e.g. a typo
+customer_fuzzy_min_similarity = float(os.environ.get('CUSTOMER_FUZZY_MIN_SIMILARITY', '0.75'))
+#Names with the same sound key compared per fuzzy lookup, half of them at least as long as the searched name
+customer_fuzzy_candidates = int(os.environ.get('CUSTOMER_FUZZY_CANDIDATES', '20'))
+#Largest page /check_inventory returns when the caller asks for a Limit
+inventory_max_limit = int(os.environ.get('INVENTORY_MAX_LIMIT', '100'))
+
+
+#What the handlers need to know about the data file of one store: its ShoeInventory columns, the column
+#holding the shoe size (if the catalog has one) and whether the FTS5 customer name index is available.
+#prepare_db records it in the snapshot's cache each time the file is opened, so every store answers
+#from its own schema.
+class StoreSchema:
+    def __init__(self, inventory_columns, size_column, name_index):
+        self.inventory_columns = inventory_columns
+        self.size_column = size_column
+        self.name_index = name_index
+
+
+#Schema of the default catalog, used by the key-value backend when no data file is opened
+default_schema = StoreSchema(['ShoeID', 'BestFitActivity', 'StyleDesc', 'ShoeColors', 'Price', 'InvCount'], None, False)
+
+#All queries are constant, parameterized statements: sqlite3 compiles each one once per connection
+#and serves later executions from its statement cache, and values can never change the SQL
+customer_columns = 'customerId, customerName, Addr1, Addr2, City, State, Zipcode, PreferredActivity, ShoeSize, OtherInfo'
+SQL_CUSTOMER_EXACT = 'SELECT ' + customer_columns + ' from CustomerInfo where customerName = ? COLLATE NOCASE LIMIT ?'
+SQL_CUSTOMER_PREFIX = ('SELECT ' + customer_columns + ' from CustomerInfo where customerName >= ? COLLATE NOCASE '
+                       'and customerName < ? COLLATE NOCASE LIMIT 50')
+SQL_CUSTOMER_TRIGRAM = ('SELECT ' + customer_columns + ' from CustomerInfo where rowid in '
+                        '(SELECT rowid from CustomerNameIndex where CustomerNameIndex match ? LIMIT 50)')
+SQL_CUSTOMER_LIKE = 'SELECT ' + customer_columns + ' from CustomerInfo where customerName like ? LIMIT 50'
+#Names with the same sound key and the closest lengths: two bounded ranges of the (NameKey, NameLength) index
+SQL_CUSTOMER_FUZZY = ('SELECT ' + customer_columns + ' from CustomerInfo where rowid in '
+                      '(SELECT CustomerRowid FROM (SELECT CustomerRowid from CustomerNameKey where NameKey = ? '
+                      'and NameLength >= ? ORDER BY NameLength LIMIT ?) '
+                      'UNION ALL SELECT CustomerRowid FROM (SELECT CustomerRowid from CustomerNameKey where NameKey = ? '
+                      'and NameLength < ? ORDER BY NameLength DESC LIMIT ?))')
+SQL_SHOE_INVENTORY = 'SELECT ShoeID, BestFitActivity, StyleDesc, ShoeColors, Price, InvCount from ShoeInventory'
+#Price is stored as text; this expression (and the index on it) compares it as a number
+SQL_PRICE = "CAST(LTRIM(Price, '$') AS REAL)"
+
+
+#Raised for invalid request parameters, lambda_handler answers it with a 400
+class BadRequest(ValueError):
+    pass
+
+
+#A response body that is already JSON encoded; lambda_handler passes it through unchanged
+class EncodedBody(str):
+    pass
+
+
+#Runs a read query and returns the rows as dicts, resolving the column names once per query
+def fetch_dicts(sql, params=()):
+    if db.in_transaction:
+        #already timed as part of the transaction
+        return query_dicts(db.conn, sql, params)
+    with metrics.timer('SqlTime'), db.lock:
+        return query_dicts(db.reader(), sql, params)
+
+
+def query_dicts(conn, sql, params):
+    cur = conn.execute(sql, params)
+    names = [description[0] for description in cur.description]
+    rows = [dict(zip(names, row)) for row in cur.fetchall()]
+    metrics.add('Rows', len(rows))
+    return rows
+
+
+soundex_codes = {letter: digit for letters, digit in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'), ('l', '4'),
+                                                      ('mn', '5'), ('r', '6')) for letter in letters}
+
+
+#Soundex code of a lowercase word: its first letter and up to three digits for the consonant sounds
+#that follow, so "jhon" and "john" (J500) or "smyth" and "smith" (S530) get the same code
+def soundex(word):
+    code, last = word[0].upper(), soundex_codes.get(word[0])
+    for letter in word[1:]:
+        digit = soundex_codes.get(letter)
+        if digit is not None and digit != last:
+            code += digit
+        if letter not in 'hw':
+            last = digit
+    return (code + '000')[:4]
+
+
+#Sound key of a customer name: the Soundex codes of its words, ignoring numbers and punctuation.
+#Misspellings that keep each word's first letter and consonant sounds share the key of the real name.
+def name_key(name):
+    return ' '.join(soundex(word) for word in re.findall('[a-z]+', (name or '').lower()))
+
+
+#Builds the customer name indexes when a snapshot is opened: a NOCASE b-tree for exact and prefix
+#matches, an FTS5 trigram table for substring matches and a sound key table for fuzzy matches. Both are stored in the database file,
+#so a compacted snapshot already carries them and later cold starts skip the build.
+def prepare_db(snapshot, conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_customer_name_nocase ON CustomerInfo (customerName COLLATE NOCASE)')
+    #indexes behind the /check_inventory filters
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_shoe_activity ON ShoeInventory (BestFitActivity COLLATE NOCASE, ShoeID)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_shoe_price ON ShoeInventory (' + SQL_PRICE + ')')
+    inventory_columns = [row[1] for row in conn.execute('PRAGMA table_info(ShoeInventory)')]
+    size_column = next((c for c in inventory_columns if c.lower() in ('shoesize', 'size')), None)
+    if size_column is not None:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_shoe_size ON ShoeInventory ({size_column}, ShoeID)')
+    prepare_order_stats(conn)
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'CustomerNameKey'").fetchone():
+        conn.create_function('name_key', 1, name_key, deterministic=True)
+        conn.execute('CREATE TABLE CustomerNameKey (NameKey TEXT NOT NULL, NameLength INTEGER NOT NULL, '
+                     'CustomerRowid INTEGER NOT NULL)')
+        conn.execute('INSERT INTO CustomerNameKey (NameKey, NameLength, CustomerRowid) '
+                     'SELECT name_key(customerName), length(customerName), rowid from CustomerInfo')
+        conn.execute('CREATE INDEX idx_customer_name_key ON CustomerNameKey (NameKey, NameLength, CustomerRowid)')
+        logger.info('Built customer name key index')
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'CustomerNameIndex'").fetchone()
+    try:
+        if exists is None:
+            conn.execute("CREATE VIRTUAL TABLE CustomerNameIndex USING fts5(customerName, content='CustomerInfo', "
+                         "content_rowid='rowid', tokenize='trigram')")
+            conn.execute("INSERT INTO CustomerNameIndex (CustomerNameIndex) VALUES ('rebuild')")
+            logger.info('Built customer name index')
+        name_index = True
+    except sqlite3.OperationalError as e:
+        #SQLite without FTS5/trigram support, substring matches fall back to a scan
+        logger.info(f'Customer name index unavailable: {e}')
+        name_index = False
+    conn.commit()
+    snapshot.cache['schema'] = StoreSchema(inventory_columns, size_column, name_index)
+
+
+#Returns the StoreSchema of a snapshot, opening its file if a concurrent refresh has just closed it
+def store_schema(snapshot):
+    schema = snapshot.cache.get('schema')
+    if schema is not None:
+        return schema
+    if not uses_snapshots:
+        return default_schema #the key-value backend has no data file open
+    with snapshot.lock:
+        snapshot.connection()
+        return snapshot.cache['schema']
+
+
+#In-memory inverted index of the catalog behind /recommend: shoe rows by BestFitActivity (case
+#insensitive) and then by shoe size, when the catalog has a size column, each list in ShoeID order.
+#It is built from ShoeInventory once per store and kept current by applying the orders of each local
+#commit and replayed journal entry to InvCount. Anything else that changes the data (a new snapshot,
+#a repaired copy) bumps the store version without going through apply(), so the next lookup rebuilds it.
+class ShoeIndex:
+    def __init__(self, rows, size_column, version):
+        self.version = version
+        self.size_column = size_column
+        self.shoes = {row['ShoeID']: row for row in rows}
+        self.by_activity = {}
+        for row in sorted(rows, key=lambda row: row['ShoeID']):
+            sizes = self.by_activity.setdefault(self.activity_key(row['BestFitActivity']), {})
+            sizes.setdefault(self.size_key(row[size_column]) if size_column else None, []).append(row)
+
+    @staticmethod
+    def activity_key(activity):
+        return str(activity or '').strip().lower()
+
+    @staticmethod
+    def size_key(size):
+        return None if size is None else str(size)
+
+    def apply(self, ops, version):
+        for op in ops:
+            if op['op'] == 'order':
+                shoe = self.shoes.get(op['ShoeID'])
+                if shoe is not None:
+                    shoe['InvCount'] -= op.get('Quantity', 1)
+        self.version = version
+
+    #In-stock shoes for an activity: those in the given size, then (to fill up to limit) other sizes
+    def lookup(self, activity, size, limit):
+        sizes = self.by_activity.get(self.activity_key(activity), {})
+        size = self.size_key(size) if self.size_column else None
+        in_size = [dict(row) for row in sizes.get(size, []) if row['InvCount'] > 0][:limit]
+        others = sorted((row for other, rows in sizes.items() if other != size for row in rows if row['InvCount'] > 0),
+                        key=lambda row: row['ShoeID'])
+        return in_size, [dict(row) for row in others[:limit - len(in_size)]]
+
+
+#Returns the ShoeIndex of a store, building it when the store has none for its current data
+def shoe_index(snapshot):
+    with snapshot.lock:
+        index = snapshot.cache.get('shoe_index')
+        if index is not None and index.version == snapshot.version:
+            return index
+        reader = snapshot.reader() #may open the store, which bumps its version
+        schema = store_schema(snapshot)
+        with metrics.timer('SqlTime'):
+            rows = query_dicts(reader, 'SELECT ' + ', '.join(schema.inventory_columns) + ' from ShoeInventory', ())
+        index = ShoeIndex(rows, schema.size_column, snapshot.version)
+        snapshot.cache['shoe_index'] = index
+        logger.info(f'Built shoe index of {snapshot.key} with {len(rows)} shoes')
+        return index
+
+
+#Creates the order aggregate tables and fills them from OrderDetails the first time a data file is
+#opened; from then on apply_ops keeps them current and compacted snapshots carry them
+def prepare_order_stats(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'OrderStatsByShoe'").fetchone():
+        return
+    conn.execute('CREATE TABLE OrderStatsByShoe (ShoeID INTEGER PRIMARY KEY, BestFitActivity TEXT, '
+                 'Pairs INTEGER NOT NULL, LastOrderDate TEXT)')
+    conn.execute('CREATE INDEX idx_shoe_stats_pairs ON OrderStatsByShoe (Pairs DESC, ShoeID)')
+    conn.execute('CREATE INDEX idx_shoe_stats_activity ON OrderStatsByShoe '
+                 '(BestFitActivity COLLATE NOCASE, Pairs DESC, ShoeID)')
+    conn.execute('CREATE TABLE OrderStatsByCustomer (CustomerID INTEGER NOT NULL, ShoeID INTEGER NOT NULL, '
+                 'Pairs INTEGER NOT NULL, FirstOrderDate TEXT, LastOrderDate TEXT, PRIMARY KEY (CustomerID, ShoeID))')
+    conn.execute('INSERT INTO OrderStatsByShoe (ShoeID, BestFitActivity, Pairs, LastOrderDate) '
+                 'SELECT o.ShoeID, s.BestFitActivity, count(*), max(o.OrderDate) from OrderDetails o '
+                 'LEFT JOIN ShoeInventory s ON s.ShoeID = o.ShoeID GROUP BY o.ShoeID')
+    conn.execute('INSERT INTO OrderStatsByCustomer (CustomerID, ShoeID, Pairs, FirstOrderDate, LastOrderDate) '
+                 'SELECT CustomerID, ShoeID, count(*), min(OrderDate), max(OrderDate) from OrderDetails '
+                 'GROUP BY CustomerID, ShoeID')
+    logger.info('Built order statistics')
+
+
+#How long and how many recent order outcomes are kept to answer retried /place_order calls
+order_idempotency_ttl_seconds = float(os.environ.get('ORDER_IDEMPOTENCY_TTL_SECONDS', '900'))
+order_idempotency_max_entries = int(os.environ.get('ORDER_IDEMPOTENCY_MAX_ENTRIES', '10000'))
+
+
+#Bounded map of recent results that forgets entries ttl_seconds after they were stored, oldest first
+class RecentResults:
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            self.expire()
+            entry = self.entries.get(key)
+            return entry[1] if entry is not None else None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.expire()
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def expire(self):
+        now = time.monotonic()
+        while self.entries:
+            deadline, _ = next(iter(self.entries.values()))
+            if deadline > now:
+                break
+            self.entries.popitem(last=False)
+
+
+#Outcomes of recent orders by idempotency key. Filled from our own commits and from journal entries
+#replayed from other instances, so a retry answered by another warm instance is recognised as well.
+recent_orders = RecentResults(order_idempotency_max_entries, order_idempotency_ttl_seconds)
+#Agent session of the invocation being handled, part of the order idempotency key
+session_id = None
+
+
+def remember_orders(ops):
+    for op in ops:
+        if op['op'] == 'order' and op.get('IdempotencyKey'):
+            recent_orders.put(op['IdempotencyKey'], 1)
+        elif op['op'] == 'result':
+            recent_orders.put(op['IdempotencyKey'], op['Result'])
+
+
+#on_apply hook of the stores: runs under the snapshot lock right after each commit of orders
+def applied_ops(snapshot, ops):
+    remember_orders(ops)
+    index = snapshot.cache.get('shoe_index')
+    if index is not None:
+        index.apply(ops, snapshot.version)
+
+
+store_id_pattern = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+#The DbSnapshot shards of the stores this execution environment has served, least recently used first.
+#Beyond the memory budget the least recently used stores are closed (their files stay, so reopening
+#is a 304 and a journal replay); beyond the /tmp budget their files are deleted as well. The store in
+#use and stores whose write-behind orders cannot be flushed are never evicted, and files without a
+#bucket behind them are never deleted. Use counts are kept in a small file next to the stores so a
+#restarted process can prefetch the hot ones.
+class StoreCache:
+    def __init__(self, open_store, directory, tmp_budget_bytes, memory_budget_bytes, store_memory_bytes):
+        self.open_store = open_store
+        self.directory = directory
+        self.tmp_budget_bytes = tmp_budget_bytes
+        self.memory_budget_bytes = memory_budget_bytes
+        self.store_memory_bytes = store_memory_bytes
+        self.snapshots = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits_path = os.path.join(directory, 'hits.json')
+        self.unsaved_hits = 0 #hits and stores changed since the use counts were last saved
+        self.stores_changed = False
+        self.hits = {}
+        if os.path.exists(self.hits_path):
+            with open(self.hits_path, 'r') as hits_fp:
+                self.hits = json.load(hits_fp)
+
+    #Returns the shard of a store, creating it (without syncing) on first use
+    def get(self, store_id, hit=True):
+        with self.lock:
+            snapshot = self.snapshots.pop(store_id, None)
+            if snapshot is None:
+                snapshot = self.open_store(store_id)
+                self.stores_changed = True
+            self.snapshots[store_id] = snapshot
+            if hit:
+                self.hits[store_id] = self.hits.get(store_id, 0) + 1
+                self.unsaved_hits += 1
+            return snapshot
+
+    #Forgets a store that turned out not to exist, so it neither stays in memory nor gets prefetched
+    def discard(self, store_id):
+        with self.lock:
+            snapshot = self.snapshots.pop(store_id, None)
+            self.hits.pop(store_id, None)
+            self.stores_changed = True
+        if snapshot is not None:
+            if snapshot.bucket is not None:
+                snapshot.remove_files()
+            else:
+                snapshot.stop_flusher()
+                snapshot.close()
+
+    def hot(self, count):
+        return sorted(self.hits, key=self.hits.get, reverse=True)[:count]
+
+    #Closes and deletes least recently used stores until both budgets are met
+    def evict(self, in_use):
+        with self.lock:
+            candidates = [(store_id, snapshot) for store_id, snapshot in self.snapshots.items() if snapshot is not in_use]
+            open_stores = sum(1 for snapshot in self.snapshots.values() if snapshot.conn is not None)
+            for store_id, snapshot in candidates:
+                if open_stores * self.store_memory_bytes <= self.memory_budget_bytes:
+                    break
+                if snapshot.conn is not None and self.release(snapshot):
+                    snapshot.close()
+                    open_stores -= 1
+            used = sum(snapshot.disk_usage() for snapshot in self.snapshots.values())
+            for store_id, snapshot in candidates:
+                if used <= self.tmp_budget_bytes:
+                    break
+                if snapshot.bucket is not None and self.release(snapshot):
+                    used -= snapshot.disk_usage()
+                    snapshot.remove_files()
+                    del self.snapshots[store_id]
+                    self.stores_changed = True
+                    logger.info(f'Evicted store {store_id} from {self.directory}')
+            if self.stores_changed or self.unsaved_hits >= 100:
+                self.save_hits()
+
+    #Flushes the write-behind orders of a store about to be evicted, returns False if some remain
+    def release(self, snapshot):
+        try:
+            snapshot.flush_all()
+            return True
+        except Exception as e:
+            logger.info(f'Keeping {snapshot.key}, its pending orders could not be flushed: {e}')
+            return False
+
+    def save_hits(self):
+        self.unsaved_hits = 0
+        self.stores_changed = False
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.hits_path, 'w') as hits_fp:
+            json.dump(self.hits, hits_fp)
+
+    def flush_all(self):
+        with self.lock:
+            snapshots = list(self.snapshots.values())
+        for snapshot in snapshots:
+            snapshot.flush_all()
+
+
+def open_store(store_id):
+    if store_id == default_store:
+        key, local_path = db_name, local_db
+    else:
+        os.makedirs(store_dir, exist_ok=True)
+        key, local_path = f'stores/{store_id}/{db_name}', os.path.join(store_dir, f'{store_id}.db')
+    snapshot = DbSnapshot(bucket, key, local_path, db_revalidate_seconds, journal_compact_threshold, max_commit_attempts,
+                          journal_retention_seconds, prepare_db, applied_ops, write_behind_seconds, journal_applied_keep,
+                          compaction_requested.set)
+    if write_behind_seconds > 0:
+        snapshot.start_flusher()
+    return snapshot
+
+
+#Set when a store's journal reached the compaction threshold; compact_due() then compacts it after the response
+compaction_requested = threading.Event()
+stores = StoreCache(open_store, store_dir, store_tmp_budget_mb * 2 ** 20, store_memory_budget_mb * 2 ** 20,
+                    2 * sqlite_cache_kib * 1024)
+#Shard of the store the current invocation is for; the handlers below read and write through it
+db = stores.get(default_store, hit=False)
+
+#Set when an invocation has returned its response; the flush extension then persists pending orders
+invocation_done = threading.Event()
+
+
+#Flushes write-behind orders on the way out. Failures are only logged: the orders stay in JournalPending
+#in /tmp and are flushed by the next process that opens the file, if the environment is reused.
+def flush_pending():
+    try:
+        stores.flush_all()
+    except Exception as e:
+        logger.info(f'Could not flush pending orders: {e}')
+
+
+#Compacts the journals of the stores that reached the threshold. Failures are only logged: the journal
+#stays valid and the next order on the store asks again.
+def compact_due():
+    compaction_requested.clear()
+    with stores.lock:
+        snapshots = list(stores.snapshots.values())
+    for snapshot in snapshots:
+        try:
+            snapshot.compact_if_due()
+        except Exception as e:
+            logger.info(f'Could not compact {snapshot.key}: {e}')
+
+
+#Lambda internal extension (a thread of this process registered with the Extensions API) that flushes
+#pending write-behind orders and compacts journals after each invocation has returned its response.
+#Lambda does not freeze the execution environment until every extension has asked for its next event,
+#so orders committed by an invocation are in the S3 journal before the environment can be frozen or
+#reclaimed, while the agent gets its response without waiting for S3.
+def start_flush_extension():
+    extension_api = f'http://{os.environ["AWS_LAMBDA_RUNTIME_API"]}/2020-01-01/extension'
+    request = urllib.request.Request(f'{extension_api}/register', data=json.dumps({'events': ['INVOKE']}).encode('utf-8'),
+                                     headers={'Lambda-Extension-Name': os.path.basename(__file__)}, method='POST')
+    with urllib.request.urlopen(request) as response:
+        extension_id = response.headers['Lambda-Extension-Identifier']
+
+    def run():
+        while True:
+            #blocks until the next invocation starts; asking for it also tells Lambda we are done
+            next_event = urllib.request.Request(f'{extension_api}/event/next',
+                                                headers={'Lambda-Extension-Identifier': extension_id})
+            with urllib.request.urlopen(next_event) as response:
+                response.read()
+            invocation_done.wait()
+            invocation_done.clear()
+            flush_pending()
+            if compaction_requested.is_set():
+                compact_due()
+
+    threading.Thread(target=run, name='flush-extension', daemon=True).start()
+
+
+#Outside Lambda, or without the extension, journals are compacted on a background thread
+def start_compactor():
+    def run():
+        while True:
+            compaction_requested.wait()
+            compact_due()
+
+    threading.Thread(target=run, name='compactor', daemon=True).start()
+
+
+flush_extension_started = False
+if write_behind_seconds > 0 or (bucket and uses_snapshots):
+    if os.environ.get('AWS_LAMBDA_RUNTIME_API'):
+        try:
+            start_flush_extension()
+            flush_extension_started = True
+        except Exception as e:
+            logger.info(f'Flush extension unavailable, pending orders rely on the flusher and compactor: {e}')
+if bucket and uses_snapshots and not flush_extension_started:
+    start_compactor()
+if write_behind_seconds > 0:
+    atexit.register(flush_pending)
+    #Lambda sends SIGTERM before shutting down an environment that has extensions registered
+    if threading.current_thread() is threading.main_thread():
+        previous_sigterm = signal.getsignal(signal.SIGTERM)
 
-#Download data file from S3
-s3.download_file(bucket, db_name, local_db)
+        def on_sigterm(signum, frame):
+            flush_pending()
+            if callable(previous_sigterm):
+                previous_sigterm(signum, frame)
+            else:
+                sys.exit(0)
 
-cursor = None
-conn = None
+        signal.signal(signal.SIGTERM, on_sigterm)
 
-#Initial data load and SQLite3 cursor creation 
-def load_data():
-    #load SQL Lite database from S3
-    # create the db
-    global conn
-    conn = sqlite3.connect(local_db)
-    cursor = conn.cursor()
-    logger.info('Completed initial data load ')
 
-    return cursor
+#Downloads the data files (reusing /tmp copies that are still current) and replays their journals on a
+#background thread, so importing boto3 and the transfers overlap with the rest of the init phase.
+#The default store comes first, then the configured and the hot stores, up to the memory budget.
+def prefetch():
+    if not uses_snapshots:
+        return
+    store_ids = [default_store] + store_prefetch + stores.hot(store_prefetch_hot)
+    store_ids = list(dict.fromkeys(store_ids))[:max(1, int(stores.memory_budget_bytes // stores.store_memory_bytes))]
+    for store_id in store_ids:
+        snapshot = stores.get(store_id, hit=False)
+        if snapshot.last_synced is not None:
+            continue #an invocation got there first
+        try:
+            snapshot.sync()
+            shoe_index(snapshot)
+        except Exception as e:
+            #the first invocation for the store syncs again and reports the error
+            logger.info(f'Prefetch of {snapshot.key} failed: {e}')
+
+prefetch_thread = threading.Thread(target=prefetch, name='prefetch', daemon=True)
+prefetch_thread.start()
+
+#Revalidates the local copy of the SQL Lite database against S3 before an invocation. A sync that
+#finished after the invocation started (e.g. the prefetch the first invocation waited for) is reused.
+def load_data(started=None):
+    db.sync(fresh_after=started)
+    logger.info('Completed data load ')
     
-#Function returns all customer info for a particular customerId
+#Orders customer rows shortest name first, i.e. the least extra text around the searched name.
+#Keys carry the column names as declared in the database, so the name column is looked up by value position.
+def closest_names(rows):
+    return sorted(rows, key=lambda row: len(list(row.values())[1] or ''))
+
+
+#Keeps the candidate rows whose name is similar enough to the searched one and about as similar as the
+#best one, most similar first; a clearly closer name is returned on its own
+def similar_names(name, rows):
+    name = name.lower()
+    scored = []
+    for row in rows:
+        similarity = difflib.SequenceMatcher(None, name, (list(row.values())[1] or '').lower()).ratio()
+        if similarity >= customer_fuzzy_min_similarity:
+            scored.append((similarity, row))
+    scored.sort(key=lambda scored_row: scored_row[0], reverse=True)
+    return [row for similarity, row in scored if similarity >= scored[0][0] - 0.05]
+
+
+#Returns customer rows for the first non-empty match tier: exact name, name prefix, substring, then fuzzy
+#(misspelt names such as "Jhon Doe")
+def find_customers(custName, limit):
+    name = custName.strip()
+    rows = fetch_dicts(SQL_CUSTOMER_EXACT, (name, limit + 1))
+    if rows:
+        return rows, 'exact'
+
+    #prefix range over the NOCASE index, shortest (closest) names first
+    rows = fetch_dicts(SQL_CUSTOMER_PREFIX, (name, name + '\U0010ffff'))
+    if rows:
+        return closest_names(rows)[:limit + 1], 'prefix'
+
+    #substring matches need at least one trigram; shorter names only match exactly or by prefix
+    if len(name) < 3:
+        return [], 'substring'
+    name_index = store_schema(db).name_index
+    if name_index:
+        rows = fetch_dicts(SQL_CUSTOMER_TRIGRAM, ('"' + name.replace('"', '""') + '"',))
+    else:
+        rows = fetch_dicts(SQL_CUSTOMER_LIKE, ('%' + name + '%',))
+    if rows:
+        return closest_names(rows)[:limit + 1], 'substring'
+
+    #names that sound the same and are about as long, ranked by how similar the whole name is
+    key = name_key(name)
+    if not key:
+        return [], 'fuzzy'
+    half = customer_fuzzy_candidates // 2
+    rows = fetch_dicts(SQL_CUSTOMER_FUZZY, (key, len(name), half, key, len(name), half))
+    return similar_names(name, rows)[:limit + 1], 'fuzzy'
+
+
+#Function returns all customer info for the customer best matching the given name, or a bounded
+#list of candidates when the name matches several customers equally well
 def return_customer_info(custName):
-    query = 'SELECT customerId, customerName, Addr1, Addr2, City, State, Zipcode, PreferredActivity, ShoeSize, OtherInfo from CustomerInfo where customerName like "%' +  custName +'%"'
-    cursor.execute(query)
-    resp = cursor.fetchall()
-    #adding column names to response values
-    names = [description[0] for description in cursor.description]
-    valDict = {}
-    index = 0
-    for name in names:
-        valDict[name]=resp[0][index]
-        index = index + 1
+    resp, match = find_customers(custName, customer_match_limit)
+    if not resp:
+        logger.info('Customer Info not found')
+        return {'message': f'No customer found with a name matching {custName}'}
+    if len(resp) > 1:
+        logger.info(f'{len(resp)} customers match by {match}')
+        return {'message': f'Several customers match {custName}, ask the customer which one they are',
+                'candidates': resp[:customer_match_limit]}
     logger.info('Customer Info retrieved')
-    return valDict
+    return resp[0]
    
     
-#Function returns shoe inventory for a particular shoeid 
+#Function returns shoe inventory for all shoes
 def return_shoe_inventory():
-    query = 'SELECT ShoeID, BestFitActivity, StyleDesc, ShoeColors, Price, InvCount from ShoeInventory' 
-    cursor.execute(query)
-    resp = cursor.fetchall()
-    
-    #adding column names to response values
-    names = [description[0] for description in cursor.description]
-    valDict = []
-    interimDict = {}
-    index = 0
-    for item in resp:
-        for name in names:
-            interimDict[name]=item[index]
-            index = index + 1
-        index = 0
-        valDict.append(interimDict)
-        interimDict={}
+    valDict = fetch_dicts(SQL_SHOE_INVENTORY)
     logger.info('Shoe info retrieved')
     return valDict
 
+
+#Builds a normalized, hashable filter from the optional /check_inventory parameters, or None
+#when no parameter is set (the full inventory)
+def inventory_filter(Activity=None, ShoeSize=None, MinPrice=None, MaxPrice=None, InStockOnly=None, Fields=None,
+                     Limit=None, Cursor=None):
+    fields = None
+    if Fields:
+        fields = tuple(f.strip() for f in Fields.split(',') if f.strip())
+        inventory_columns = store_schema(db).inventory_columns
+        unknown = [f for f in fields if f not in inventory_columns]
+        if unknown:
+            raise BadRequest(f'Unknown Fields {unknown}, valid fields are {inventory_columns}')
+    if Limit is not None and not 0 < Limit <= inventory_max_limit:
+        raise BadRequest(f'Limit must be between 1 and {inventory_max_limit}')
+    inv_filter = (
+        ('activity', (Activity or '').strip() or None),
+        ('size', ShoeSize),
+        ('min_price', MinPrice),
+        ('max_price', MaxPrice),
+        ('in_stock_only', bool(InStockOnly)),
+        ('fields', fields),
+        ('limit', Limit),
+        ('cursor', Cursor),
+    )
+    return inv_filter if any(value for _, value in inv_filter) else None
+
+
+#Returns the shoes matching a filter, using the activity/price/size indexes. Pages are keyed on
+#ShoeID, so the next page starts after the last ShoeID returned (nextCursor).
+def query_shoe_inventory(inv_filter):
+    f = dict(inv_filter)
+    schema = store_schema(db)
+    columns = list(f['fields']) if f['fields'] else schema.inventory_columns
+    if 'ShoeID' not in columns:
+        columns = ['ShoeID'] + columns
+    where, params = [], []
+    if f['activity'] is not None:
+        where.append('BestFitActivity = ? COLLATE NOCASE')
+        params.append(f['activity'])
+    if f['size'] is not None and schema.size_column is not None:
+        where.append(schema.size_column + ' = ?')
+        params.append(f['size'])
+    if f['min_price'] is not None:
+        where.append(SQL_PRICE + ' >= ?')
+        params.append(f['min_price'])
+    if f['max_price'] is not None:
+        where.append(SQL_PRICE + ' <= ?')
+        params.append(f['max_price'])
+    if f['in_stock_only']:
+        where.append('InvCount > 0')
+    if f['cursor'] is not None:
+        where.append('ShoeID > ?')
+        params.append(f['cursor'])
+    query = 'SELECT ' + ', '.join(columns) + ' from ShoeInventory'
+    if where:
+        query += ' where ' + ' and '.join(where)
+    query += ' ORDER BY ShoeID'
+    if f['limit'] is not None:
+        query += ' LIMIT ?'
+        params.append(f['limit'] + 1)
+    rows = fetch_dicts(query, params)
+    page = rows if f['limit'] is None else rows[:f['limit']]
+    next_cursor = page[-1]['ShoeID'] if f['limit'] is not None and len(rows) > f['limit'] else None
+    if f['fields'] and 'ShoeID' not in f['fields']:
+        page = [{k: v for k, v in row.items() if k != 'ShoeID'} for row in page]
+    if f['limit'] is None:
+        return page
+    return {'shoes': page, 'nextCursor': next_cursor}
+
+
+#Encoded /check_inventory bodies and the data version they were built from. Inventory is read
+#far more often than it changes, so until an order or a sync bumps db.version a cached body is
+#served as is, without SQL or JSON encoding. Bodies are keyed by the normalized filter.
+inventory_cache_entries = 256
+
+
+def cached_shoe_inventory(inv_filter=None):
+    inventory_cache = db.cache.setdefault('inventory', {'version': None, 'bodies': {}})
+    if inventory_cache['version'] != db.version:
+        inventory_cache['bodies'] = {}
+        inventory_cache['version'] = db.version
+    body = inventory_cache['bodies'].get(inv_filter)
+    if body is not None:
+        logger.info('Shoe info served from cache')
+        return body
+    if inv_filter is None:
+        inventory = return_shoe_inventory()
+        with metrics.timer('EncodeTime'):
+            body = EncodedBody(json.dumps(inventory))
+    else:
+        inventory = query_shoe_inventory(inv_filter)
+        with metrics.timer('EncodeTime'):
+            body = EncodedBody(json.dumps(inventory))
+        logger.info('Filtered shoe info retrieved')
+    if len(inventory_cache['bodies']) >= inventory_cache_entries:
+        inventory_cache['bodies'].clear()
+    inventory_cache['bodies'][inv_filter] = body
+    return body
+
+
+#Largest number of shoes /recommend returns
+recommend_limit = int(os.environ.get('RECOMMEND_LIMIT', '5'))
+
+
+#Joins a customer with the in-stock shoes for their PreferredActivity, in their ShoeSize first, so the
+#agent gets recommendations in one call instead of reading the whole inventory. Name matching is the
+#same as /customer/{CustomerName}: several matches return the candidates and no recommendations.
+def recommend_shoes(custName, index):
+    resp, match = find_customers(custName, customer_match_limit)
+    if not resp:
+        logger.info('Customer Info not found')
+        return {'message': f'No customer found with a name matching {custName}'}
+    if len(resp) > 1:
+        logger.info(f'{len(resp)} customers match by {match}')
+        return {'message': f'Several customers match {custName}, ask the customer which one they are',
+                'candidates': resp[:customer_match_limit]}
+    customer = resp[0]
+    activity, size = customer.get('PreferredActivity'), customer.get('ShoeSize')
+    in_size, other_sizes = index.lookup(activity, size, recommend_limit)
+    result = {'customer': customer, 'recommendations': in_size + other_sizes}
+    if not in_size:
+        result['message'] = (f'No {activity} shoes in size {size} are in stock, these are in other sizes' if other_sizes
+                             else f'No {activity} shoes are in stock')
+    logger.info(f'{len(in_size) + len(other_sizes)} shoes recommended')
+    return result
+
     
-#function places order -- reduces shoe inventory, updates order_details table --> all actions resulting from a shoe purchase  
-def place_shoe_order(ssId, custId):
-    global cursor
-    global conn
-    query = 'Update ShoeInventory set InvCount = InvCount - 1 where ShoeID = ' + str(ssId)
-    ret = cursor.execute(query)
-    
+#Journal operations for one shoe purchase of quantity pairs
+def order_ops(ssId, custId, key=None, quantity=1):
     today = datetime.today().strftime('%Y-%m-%d')
-    query = 'INSERT INTO OrderDetails (orderdate, shoeId, CustomerId) VALUES ("'+today+'",'+str(ssId)+','+ str(custId)+')'
-    ret = cursor.execute(query)
-    conn.commit()
+    op = {'op': 'order', 'OrderDate': today, 'ShoeID': int(ssId), 'CustomerID': int(custId)}
+    if quantity != 1:
+        op['Quantity'] = quantity
+    if key is not None:
+        op['IdempotencyKey'] = key
+    return [op]
+
+
+#Checks the stock of a shoe and, if there are enough pairs, orders them in the open write transaction.
+#The check and the decrement run under the store lock in the same transaction, so no other order can
+#take the pairs in between. With write-behind the check sees this instance's copy only, and orders
+#other instances have not flushed yet can still take the same pairs.
+#Returns the journal operations (none when the line fails) and the outcome of the line.
+def reserve_shoes(ssId, custId, quantity=1, key=None):
+    cur = db.conn.cursor()
+    line = {'ShoeID': ssId, 'Quantity': quantity}
+    row = cur.execute('SELECT InvCount from ShoeInventory where ShoeID = ?', (ssId,)).fetchone()
+    if row is None:
+        line.update(status='failed', message=f'ShoeID {ssId} does not exist')
+        return [], line
+    if row[0] < quantity:
+        line.update(status='failed', message=f'Only {max(row[0], 0)} pairs of ShoeID {ssId} in stock')
+        return [], line
+    ops = order_ops(ssId, custId, key, quantity)
+    apply_ops(cur, ops)
+    line['status'] = 'ordered'
+    return ops, line
+
+
+#Identifies an order across retries of the same action group call: the agent session plus the order
+#itself and the optional RequestToken the agent passes to place the same order again on purpose.
+#Without a session or a token there is nothing to tell a retry from a new order, so no key.
+def order_key(ssId, custId, token=None):
+    if session_id is None and token is None:
+        return None
+    return json.dumps([db.key, session_id, int(custId), int(ssId), token])
+
+
+#Answer to a repeated order, so the agent can tell the customer that no new order was placed
+ORDER_REPLAYED_MESSAGE = ('Order already placed in this session, no new order was placed. '
+                          'To order the same again, repeat the call with a new RequestToken')
+
+
+#Returns the answer to an order placed in the last ORDER_IDEMPOTENCY_TTL_SECONDS, or None: the earlier
+#outcome marked as a replay
+def recent_order(key):
+    if key is None:
+        return None
+    result = recent_orders.get(key)
+    if result is None:
+        return None
+    logger.info(f'Order {key} already placed, returning the earlier outcome')
+    metrics.add('IdempotentReplays', 1)
+    return replayed_order(result)
+
+
+def replayed_order(result):
+    if isinstance(result, dict):
+        return dict(result, message=ORDER_REPLAYED_MESSAGE, replayed=True)
+    return {'message': ORDER_REPLAYED_MESSAGE, 'replayed': True}
+
+
+#function places order -- reduces shoe inventory, updates order_details table --> all actions resulting from a shoe purchase  
+def place_shoe_order(ssId, custId, key=None):
+    def work():
+        #a rebase may have replayed the same order committed by another instance
+        result = recent_order(key)
+        if result is not None:
+            return [], result
+        ops, line = reserve_shoes(ssId, custId, key=key)
+        return ops, (1 if ops else {'message': line['message']})
+
+    #the order is written to the local copy and appended to the S3 order journal as one small object
+    result = db.transaction(work)
+    logger.info(f'Shoe order placed at journal sequence {db.seq}')
+    return result
+
+
+#Storage backend of the customer, inventory and order operations. SqliteBackend is the S3 data file
+#with its order journal, through the functions above; it supports every operation. KeyValueBackend
+#keeps customers, shoes and orders as items of a key-value store and inventory as atomic counters, so
+#any number of instances can take orders at once without a single writer; it supports the operations
+#listed in its operation_ids. Both answer with the same bodies.
+class SqliteBackend:
+    operation_ids = None #all
+
+    #Revalidates the data file of the store the invocation is for
+    def sync(self, started=None):
+        load_data(started)
+
+    def customer_info(self, custName):
+        return return_customer_info(custName)
+
+    def shoe_inventory(self, inv_filter=None, in_batch=False):
+        if in_batch:
+            #the encoded-body cache does not know about uncommitted batch writes
+            return query_shoe_inventory(inv_filter) if inv_filter else return_shoe_inventory()
+        return cached_shoe_inventory(inv_filter)
+
+    #Returns the order outcome and the journal operations left in an open batch transaction
+    def place_order(self, ssId, custId, key=None, in_batch=False):
+        if in_batch:
+            ops, line = reserve_shoes(ssId, custId, key=key)
+            return (1 if ops else {'message': line['message']}), ops
+        return place_shoe_order(ssId, custId, key), []
+
+
+#In-process key-value store with the semantics KeyValueBackend needs: items are dicts addressed by a
+#partition and a key, put_new() only writes absent items and add() is an atomic, optionally floored
+#counter update. Used as the local stand-in for DynamoDbKeyValue by the bench (KV_TABLE_NAME=:memory:).
+class InMemoryKeyValue:
+    def __init__(self):
+        self.partitions = {}
+        self.lock = threading.Lock()
+
+    def get(self, partition, key):
+        with self.lock:
+            item = self.partitions.get(partition, {}).get(str(key))
+            return dict(item) if item is not None else None
+
+    def put(self, partition, key, item):
+        with self.lock:
+            self.partitions.setdefault(partition, {})[str(key)] = dict(item)
+
+    #Writes (partition, key, item) triples, replacing existing items
+    def put_all(self, items):
+        for partition, key, item in items:
+            self.put(partition, key, item)
+
+    #Writes the item unless the key exists, returns whether it was written
+    def put_new(self, partition, key, item):
+        with self.lock:
+            items = self.partitions.setdefault(partition, {})
+            if str(key) in items:
+                return False
+            items[str(key)] = dict(item)
+            return True
+
+    def items(self, partition):
+        with self.lock:
+            return [dict(item) for item in self.partitions.get(partition, {}).values()]
+
+    #Adds delta to a numeric field and returns the new value, or None when the item does not exist or
+    #the value would drop below minimum (the item is then left unchanged)
+    def add(self, partition, key, field, delta, minimum=None):
+        with self.lock:
+            item = self.partitions.get(partition, {}).get(str(key))
+            if item is None or (minimum is not None and item[field] + delta < minimum):
+                return None
+            item[field] += delta
+            return item[field]
+
+
+#The same operations on a DynamoDB table with a string partition key pk and a string sort key sk.
+#add() is an UpdateItem with a condition, so counters are atomic across all writers.
+class DynamoDbKeyValue:
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+
+    #DynamoDB returns numbers as Decimal; the bodies are encoded with json
+    @staticmethod
+    def plain(item):
+        item = {k: v for k, v in item.items() if k not in ('pk', 'sk')}
+        for k, v in item.items():
+            if type(v).__name__ == 'Decimal':
+                item[k] = int(v) if v == v.to_integral_value() else float(v)
+        return item
+
+    #DynamoDB takes no floats; they are written as Decimal
+    @staticmethod
+    def stored(item, partition, key):
+        from decimal import Decimal
+        item = {k: Decimal(str(v)) if isinstance(v, float) else v for k, v in item.items()}
+        return dict(item, pk=partition, sk=str(key))
+
+    @staticmethod
+    def is_condition_failed(error):
+        return error_status(error)[1] == 'ConditionalCheckFailedException'
+
+    def get(self, partition, key):
+        item = self.table.get_item(Key={'pk': partition, 'sk': str(key)}).get('Item')
+        return self.plain(item) if item is not None else None
+
+    def put(self, partition, key, item):
+        self.table.put_item(Item=self.stored(item, partition, key))
+
+    #Writes (partition, key, item) triples in BatchWriteItem requests of 25, replacing existing items
+    def put_all(self, items):
+        with self.table.batch_writer() as batch:
+            for partition, key, item in items:
+                batch.put_item(Item=self.stored(item, partition, key))
+
+    def put_new(self, partition, key, item):
+        try:
+            self.table.put_item(Item=self.stored(item, partition, key), ConditionExpression='attribute_not_exists(pk)')
+            return True
+        except Exception as e:
+            if not self.is_condition_failed(e):
+                raise
+            return False
+
+    def items(self, partition):
+        from boto3.dynamodb.conditions import Key
+        request = {'KeyConditionExpression': Key('pk').eq(partition)}
+        items = []
+        while True:
+            response = self.table.query(**request)
+            items.extend(self.plain(item) for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return items
+            request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def add(self, partition, key, field, delta, minimum=None):
+        condition = 'attribute_exists(pk)'
+        values = {':delta': delta}
+        if minimum is not None:
+            condition += ' AND #field >= :floor'
+            values[':floor'] = minimum - delta
+        try:
+            response = self.table.update_item(Key={'pk': partition, 'sk': str(key)}, UpdateExpression='SET #field = #field + :delta',
+                                               ConditionExpression=condition, ExpressionAttributeNames={'#field': field},
+                                               ExpressionAttributeValues=values, ReturnValues='UPDATED_NEW')
+        except Exception as e:
+            if not self.is_condition_failed(e):
+                raise
+            return None
+        return int(response['Attributes'][field])
+
+
+#Copies the customers and shoes of an SQLite data file into a key-value store, under the partitions of
+#the store with the given key, and marks the store as seeded. Orders are not copied; the kv backend only
+#records new ones. Loading again resets the inventory counters to those of the data file.
+def load_key_value(kv, store_key, conn):
+    rows = query_dicts(conn, 'SELECT ' + customer_columns + ' from CustomerInfo', ())
+    shoes = query_dicts(conn, SQL_SHOE_INVENTORY, ())
+    names = {}
+    for row in rows:
+        names.setdefault(str(list(row.values())[1] or '').strip().lower(), []).append(list(row.values())[0])
+    kv.put_all([(f'{store_key}/customer', list(row.values())[0], row) for row in rows] +
+               [(f'{store_key}/customer_name', name, {'ids': ids}) for name, ids in names.items()] +
+               [(f'{store_key}/shoe', shoe['ShoeID'], shoe) for shoe in shoes])
+    kv.put(f'{store_key}/meta', 'seed', {'customers': len(rows), 'shoes': len(shoes), 'seededAt': int(time.time())})
+    logger.info(f'Loaded {len(rows)} customers and {len(shoes)} shoes of {store_key} into the key-value store')
+
+
+#Seeds the DynamoDB table of the kv backend with a store's customers and shoes from a local copy of its
+#data file; store_id is the StoreID sessions use, default_store for the default one
+def seed_key_value_table(table_name, db_path, store_id=None):
+    store_id = store_id or default_store
+    store_key = db_name if store_id == default_store else f'stores/{store_id}/{db_name}'
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        load_key_value(DynamoDbKeyValue(table_name), store_key, conn)
+    finally:
+        conn.close()
+
+
+class KeyValueBackend:
+    operation_ids = ('getCustomerInfo', 'checkShoeInventory', 'placeshoeOrder')
+
+    def __init__(self, kv, load_from_snapshot=False):
+        self.kv = kv
+        self.load_from_snapshot = load_from_snapshot #fill the store from the S3 data file on first use
+        self.loaded = set() #data file keys of the stores loaded or found seeded
+        self.lock = threading.Lock()
+
+    #Items of the store the invocation is for live under partitions prefixed with its data file key
+    def partition(self, kind):
+        return f'{db.key}/{kind}'
+
+    def sync(self, started=None):
+        if db.key in self.loaded:
+            return
+        with self.lock:
+            if db.key in self.loaded:
+                return
+            if self.load_from_snapshot:
+                db.sync(fresh_after=started)
+                with db.lock:
+                    load_key_value(self.kv, db.key, db.reader())
+            elif self.kv.get(self.partition('meta'), 'seed') is None:
+                raise StoreNotFound(f'{kv_table_name} has no data for {db.key}, seed it with seed_key_value_table()')
+            self.loaded.add(db.key)
+
+    #Customer names are matched exactly (case insensitive); there is no prefix or substring index
+    def customer_info(self, custName):
+        entry = self.kv.get(self.partition('customer_name'), custName.strip().lower())
+        customers = [self.kv.get(self.partition('customer'), i) for i in (entry or {}).get('ids', [])[:customer_match_limit + 1]]
+        customers = [customer for customer in customers if customer is not None]
+        if not customers:
+            logger.info('Customer Info not found')
+            return {'message': f'No customer found with a name matching {custName}'}
+        if len(customers) > 1:
+            return {'message': f'Several customers match {custName}, ask the customer which one they are',
+                    'candidates': customers[:customer_match_limit]}
+        logger.info('Customer Info retrieved')
+        return customers[0]
+
+    def shoe_inventory(self, inv_filter=None, in_batch=False):
+        if inv_filter is not None:
+            raise BadRequest('inventory filters are not available with the kv storage backend')
+        shoes = sorted(self.kv.items(self.partition('shoe')), key=lambda shoe: shoe['ShoeID'])
+        logger.info('Shoe info retrieved')
+        return shoes
+
+    #Takes a pair with a floored atomic decrement, then records the order under its idempotency key
+    #(or a fresh id). If a concurrent retry recorded the same order first, the pair is given back.
+    def place_order(self, ssId, custId, key=None, in_batch=False):
+        if key is not None and self.kv.get(self.partition('order'), key) is not None:
+            recent_orders.put(key, 1)
+            return replayed_order(1), []
+        if self.kv.add(self.partition('shoe'), ssId, 'InvCount', -1, minimum=0) is None:
+            if self.kv.get(self.partition('shoe'), ssId) is None:
+                return {'message': f'ShoeID {ssId} does not exist'}, []
+            return {'message': f'Only 0 pairs of ShoeID {ssId} in stock'}, []
+        order = order_ops(ssId, custId)[0]
+        placed = self.kv.put_new(self.partition('order'), key if key is not None else uuid.uuid4().hex, order)
+        if not placed:
+            self.kv.add(self.partition('shoe'), ssId, 'InvCount', 1)
+        if key is not None:
+            recent_orders.put(key, 1)
+        if not placed:
+            return replayed_order(1), []
+        logger.info('Shoe order placed')
+        return 1, []
+
+
+if storage_backend == 'kv':
+    backend = KeyValueBackend(InMemoryKeyValue() if in_memory_kv else DynamoDbKeyValue(kv_table_name),
+                              load_from_snapshot=in_memory_kv)
+else:
+    backend = SqliteBackend()
+
+
+#Operation handlers by OpenAPI operationId. Each takes the decoded parameters as keyword arguments
+#plus in_batch, and returns (body, journal operations it applied). Outside a batch writes are
+#committed right away; inside a batch they stay in the open transaction.
+operation_handlers = {}
+
+
+def operation(operation_id):
+    def register(handler):
+        operation_handlers[operation_id] = handler
+        return handler
+    return register
+
+
+@operation('getCustomerInfo')
+def get_customer_info(CustomerName, in_batch=False):
+    return backend.customer_info(CustomerName), []
+
+
+@operation('placeshoeOrder')
+def place_order(ShoeID, CustomerID, RequestToken=None, in_batch=False):
+    key = order_key(ShoeID, CustomerID, RequestToken)
+    result = recent_order(key)
+    if result is not None:
+        return result, []
+    return backend.place_order(ShoeID, CustomerID, key, in_batch)
+
+
+#Largest number of lines and pairs per line accepted by a cart order
+cart_max_items = int(os.environ.get('CART_MAX_ITEMS', '20'))
+cart_max_quantity = int(os.environ.get('CART_MAX_QUANTITY', '10'))
+
+
+#Parses the Items of a cart order into a list of (ShoeID, quantity)
+def parse_cart(items):
+    try:
+        items = json.loads(items) if isinstance(items, str) else items
+    except ValueError:
+        raise BadRequest('Items must be a JSON array')
+    if not isinstance(items, list) or not items:
+        raise BadRequest('Items must be a non-empty JSON array')
+    if len(items) > cart_max_items:
+        raise BadRequest(f'a cart accepts at most {cart_max_items} items')
+    cart = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise BadRequest(f'item {index} is not an object')
+        try:
+            shoe_id, quantity = int(item['ShoeID']), int(item.get('Quantity', 1))
+        except (KeyError, TypeError, ValueError):
+            raise BadRequest(f'item {index} needs an integer ShoeID and Quantity')
+        if not 0 < quantity <= cart_max_quantity:
+            raise BadRequest(f'item {index}: Quantity must be between 1 and {cart_max_quantity}')
+        cart.append((shoe_id, quantity))
+    return cart
+
+
+#Idempotency key of a cart order, like order_key() for a single shoe
+def cart_key(custId, cart, token=None):
+    if session_id is None and token is None:
+        return None
+    return json.dumps([db.key, session_id, int(custId), cart, token])
+
+
+#Orders all lines of a cart in one write transaction persisted as one journal entry. Each line is
+#checked against the stock left by the lines before it; lines without enough stock fail on their own
+#and the others are still ordered. The per-line outcome is journaled with the orders, so a retry
+#answered by any instance gets the same report.
+@operation('placeCartOrder')
+def place_cart_order(CustomerID, Items, RequestToken=None, in_batch=False):
+    cart = parse_cart(Items)
+    key = cart_key(CustomerID, cart, RequestToken)
+    result = recent_order(key)
+    if result is not None:
+        return result, []
+
+    def work():
+        #a rebase may have replayed the same cart committed by another instance
+        result = recent_order(key)
+        if result is not None:
+            return [], result
+        ops, lines = [], []
+        for shoe_id, quantity in cart:
+            line_ops, line = reserve_shoes(shoe_id, CustomerID, quantity)
+            ops.extend(line_ops)
+            lines.append(line)
+        result = {'CustomerID': CustomerID, 'ordered': sum(1 for line in lines if line['status'] == 'ordered'),
+                  'lines': lines}
+        if ops and key is not None:
+            ops.append({'op': 'result', 'IdempotencyKey': key, 'Result': result})
+        return ops, result
+
+    if in_batch:
+        ops, result = work()
+        return result, ops
+    result = db.transaction(work)
+    logger.info(f'Cart order of {len(cart)} items placed at journal sequence {db.seq}')
+    return result, []
+
+
+@operation('checkShoeInventory')
+def check_inventory(in_batch=False, **parameters):
+    return backend.shoe_inventory(inventory_filter(**parameters), in_batch), []
+
+
+@operation('recommendShoes')
+def recommend(CustomerName, in_batch=False):
+    if in_batch:
+        #the shared index does not know about uncommitted batch writes, so index the open transaction's rows
+        schema = store_schema(db)
+        index = ShoeIndex(fetch_dicts('SELECT ' + ', '.join(schema.inventory_columns) + ' from ShoeInventory'),
+                          schema.size_column, None)
+        return recommend_shoes(CustomerName, index), []
+    return recommend_shoes(CustomerName, shoe_index(db)), []
+
+
+#Default and largest number of rows the analytics operations return
+analytics_default_limit = int(os.environ.get('ANALYTICS_DEFAULT_LIMIT', '10'))
+analytics_max_limit = int(os.environ.get('ANALYTICS_MAX_LIMIT', '50'))
+SQL_TOP_SELLERS = ('SELECT st.ShoeID, st.BestFitActivity, s.StyleDesc, s.Price, st.Pairs, st.LastOrderDate '
+                   'from OrderStatsByShoe st LEFT JOIN ShoeInventory s ON s.ShoeID = st.ShoeID '
+                   'ORDER BY st.Pairs DESC, st.ShoeID LIMIT ?')
+SQL_TOP_SELLERS_ACTIVITY = ('SELECT st.ShoeID, st.BestFitActivity, s.StyleDesc, s.Price, st.Pairs, st.LastOrderDate '
+                            'from OrderStatsByShoe st LEFT JOIN ShoeInventory s ON s.ShoeID = st.ShoeID '
+                            'where st.BestFitActivity = ? COLLATE NOCASE ORDER BY st.Pairs DESC, st.ShoeID LIMIT ?')
+SQL_CUSTOMER_ORDERS = ('SELECT cs.ShoeID, s.BestFitActivity, s.StyleDesc, s.Price, cs.Pairs, cs.FirstOrderDate, '
+                       'cs.LastOrderDate from OrderStatsByCustomer cs LEFT JOIN ShoeInventory s ON s.ShoeID = cs.ShoeID '
+                       'where cs.CustomerID = ? ORDER BY cs.LastOrderDate DESC, cs.ShoeID')
+
+
+def analytics_limit(limit):
+    if limit is None:
+        return analytics_default_limit
+    if not 0 < limit <= analytics_max_limit:
+        raise BadRequest(f'Limit must be between 1 and {analytics_max_limit}')
+    return limit
+
+
+#Best selling shoes by pairs ordered, overall or for one activity, read from OrderStatsByShoe
+@operation('getTopSellers')
+def top_sellers(Activity=None, Limit=None, in_batch=False):
+    activity = (Activity or '').strip()
+    if activity:
+        rows = fetch_dicts(SQL_TOP_SELLERS_ACTIVITY, (activity, analytics_limit(Limit)))
+    else:
+        rows = fetch_dicts(SQL_TOP_SELLERS, (analytics_limit(Limit),))
+    logger.info('Top sellers retrieved')
+    return {'topSellers': rows}, []
+
+
+#Order history of a customer, one row per shoe they bought, read from OrderStatsByCustomer
+@operation('getCustomerOrders')
+def customer_orders(CustomerID, in_batch=False):
+    rows = fetch_dicts(SQL_CUSTOMER_ORDERS, (CustomerID,))
+    logger.info('Customer orders retrieved')
+    return {'CustomerID': CustomerID, 'totalPairs': sum(row['Pairs'] for row in rows), 'shoes': rows}, []
+
+
+#Largest number of sub-operations accepted by /batch
+batch_max_operations = int(os.environ.get('BATCH_MAX_OPERATIONS', '20'))
+
+
+#Executes the sub-operations of a /batch request in order, inside one write transaction. Orders
+#are applied to the open transaction, so later reads in the batch already see them, and all of
+#them are persisted together as one journal entry. Any invalid sub-operation aborts the batch.
+@operation('runBatch')
+def run_batch(operations, in_batch=False):
+    if in_batch:
+        raise BadRequest('a batch cannot contain another batch')
+    try:
+        operations = json.loads(operations) if isinstance(operations, str) else operations
+    except ValueError:
+        raise BadRequest('operations must be a JSON array')
+    if not isinstance(operations, list) or not operations:
+        raise BadRequest('operations must be a non-empty JSON array')
+    if len(operations) > batch_max_operations:
+        raise BadRequest(f'a batch accepts at most {batch_max_operations} operations')
+
+    def work():
+        ops, results = [], []
+        for index, sub in enumerate(operations):
+            if not isinstance(sub, dict):
+                raise BadRequest(f'operation {index} is not an object')
+            api_path = sub.get('apiPath')
+            try:
+                body, new_ops = dispatch(api_path, sub.get('httpMethod', 'GET'), sub.get('parameters') or {}, in_batch=True)
+            except BadRequest as e:
+                raise BadRequest(f'operation {index} ({api_path}): {e}')
+            ops.extend(new_ops)
+            results.append({'apiPath': api_path, 'body': body})
+        return ops, results
+
+    results = db.transaction(work)
+    logger.info(f'Batch of {len(operations)} operations executed')
+    return {'results': results}, []
+
+
+#Parameter decoders by OpenAPI type; the schema uses both the standard names and 'int'
+def decode_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', '1', 'yes'):
+        return True
+    if str(value).lower() in ('false', '0', 'no', ''):
+        return False
+    raise ValueError(value)
+
+
+parameter_decoders = {'int': int, 'integer': int, 'number': float, 'boolean': decode_boolean, 'string': str}
+
+
+#One (apiPath, httpMethod) of the OpenAPI schema: its handler and a precompiled list of
+#(name, required, decoder, type) for the path, query and request-body parameters
+class Route:
+    def __init__(self, api_path, http_method, operation_id, handler, parameters):
+        self.api_path = api_path
+        self.http_method = http_method
+        self.operation_id = operation_id
+        self.handler = handler
+        self.parameters = parameters
+
+    #Turns the raw string values sent by the agent into typed keyword arguments
+    def decode(self, raw):
+        args = {}
+        for name, required, decoder, type_name in self.parameters:
+            value = raw.get(name)
+            if value is None or value == '':
+                if required:
+                    raise BadRequest(f'{name} is required')
+                continue
+            try:
+                args[name] = decoder(value)
+            except (TypeError, ValueError):
+                raise BadRequest(f'{name} must be of type {type_name}')
+        return args
+
+
+#Builds the route table from the OpenAPI schema once, at cold start. Dispatch is then a single
+#dict lookup and adding an operation only adds a table entry.
+def compile_routes(schema):
+    table = {}
+    for api_path, methods in schema.get('paths', {}).items():
+        for http_method, spec in methods.items():
+            handler = operation_handlers.get(spec.get('operationId'))
+            if handler is None:
+                logger.info(f'No handler for {http_method.upper()} {api_path}, skipping')
+                continue
+            parameters = []
+            for param in spec.get('parameters', []):
+                type_name = param.get('schema', {}).get('type', 'string')
+                parameters.append((param['name'], param.get('required', False),
+                                   parameter_decoders.get(type_name, str), type_name))
+            body_schema = spec.get('requestBody', {}).get('content', {}).get('application/json', {}).get('schema', {})
+            for name, prop in body_schema.get('properties', {}).items():
+                type_name = prop.get('type', 'string')
+                parameters.append((name, name in body_schema.get('required', []),
+                                   parameter_decoders.get(type_name, str), type_name))
+            table[(api_path, http_method.upper())] = Route(api_path, http_method.upper(), spec['operationId'], handler, parameters)
+    return table
+
+
+#OpenAPI schema of the action group, packaged next to this file
+openapi_schema_path = os.environ.get('OPENAPI_SCHEMA_PATH',
+                                     os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retail-agent-openapi.json'))
+with open(openapi_schema_path, 'r') as schema_fp:
+    routes = compile_routes(json.load(schema_fp))
+
+if prewarm and uses_snapshots:
+    #fail the init phase rather than the first invocation when the data cannot be loaded
+    prefetch_thread.join()
+    if db.last_synced is None:
+        db.sync()
+    db.validate()
+
+
+#Decodes the parameters of one operation and runs its handler
+def dispatch(api_path, http_method, raw_parameters, in_batch=False):
+    route = routes.get((api_path, (http_method or 'GET').upper()))
+    if route is None:
+        raise BadRequest("{} is not a valid api, try another one.".format(api_path))
+    if backend.operation_ids is not None and route.operation_id not in backend.operation_ids:
+        raise BadRequest(f'{api_path} is not available with the {storage_backend} storage backend')
+    return route.handler(in_batch=in_batch, **route.decode(raw_parameters))
+
+
+#Answers a retried /place_order from the recent order outcomes, before the data file is revalidated,
+#so the retry costs neither S3 requests nor SQL. Returns None when the call is not a known retry.
+def retried_order(api_path, http_method, raw_parameters):
+    route = routes.get((api_path, (http_method or 'GET').upper()))
+    if route is None or route.handler not in (place_order, place_cart_order):
+        return None
+    try:
+        parameters = route.decode(raw_parameters)
+        if route.handler is place_cart_order:
+            key = cart_key(parameters['CustomerID'], parse_cart(parameters['Items']), parameters.get('RequestToken'))
+        else:
+            key = order_key(parameters['ShoeID'], parameters['CustomerID'], parameters.get('RequestToken'))
+    except BadRequest:
+        return None
+    return recent_order(key)
+
+
+#Collects the operation parameters: path/query parameters plus the properties of a JSON request body
+def event_parameters(event):
+    parameters = {parameter["name"]: parameter["value"] for parameter in event.get('parameters') or []}
+    content = (event.get('requestBody') or {}).get('content', {}).get('application/json', {})
+    for prop in content.get('properties') or []:
+        parameters[prop["name"]] = prop["value"]
+    return parameters
 
-    #Writing updated db file to S3 and setting cursor to None to force reload of data
-    s3.upload_file(local_db, bucket, db_name)
-    cursor = None
-    logger.info('Shoe order placed')
-    return 1;
-     
 
 def lambda_handler(event, context):
+    try:
+        return handle_event(event)
+    finally:
+        invocation_done.set()
+
+
+def handle_event(event):
+    global cold_start, session_id, db
+    begin = time.perf_counter()
+    started = time.monotonic()
+    if not cold_start:
+        metrics.reset()
     responses = []
-    global cursor
-    if cursor == None:
-        cursor = load_data()
-    id = ''
+    status_code = 200
+    session_id = event.get('sessionId')
+    store_id = (event.get('sessionAttributes') or {}).get('StoreID') or default_store
     api_path = event['apiPath']
     logger.info('API Path')
     logger.info(api_path)
-    
-    if api_path == '/customer/{CustomerName}':
-        parameters = event['parameters']
-        for parameter in parameters:
-            if parameter["name"] == "CustomerName":
-                cName = parameter["value"]
-        body = return_customer_info(cName)
-    elif api_path == '/place_order':
-        parameters = event['parameters']
-        for parameter in parameters:
-            if parameter["name"] == "ShoeID":
-                id = parameter["value"]
-            if parameter["name"] == "CustomerID":
-                cid = parameter["value"]
-        body = place_shoe_order(id, cid)
-    elif api_path == '/check_inventory':
-        body = return_shoe_inventory()
-    else:
-        body = {"{} is not a valid api, try another one.".format(api_path)}
+    try:
+        parameters = event_parameters(event)
+
+        body = None
+        if not store_id_pattern.match(store_id):
+            status_code = 400
+            body = {'message': 'StoreID may only contain letters, digits, - and _'}
+        else:
+            db = stores.get(store_id)
+            body = retried_order(api_path, event.get('httpMethod'), parameters)
+        if body is None:
+            try:
+                with metrics.timer('SyncTime'):
+                    backend.sync(started)
+                with metrics.timer('HandlerTime'):
+                    body, _ = dispatch(api_path, event.get('httpMethod'), parameters)
+            except BadRequest as e:
+                status_code = 400
+                body = {'message': str(e)}
+            except StoreNotFound as e:
+                logger.info(f'Store {store_id} not found: {e}')
+                stores.discard(store_id)
+                status_code = 404
+                body = {'message': f'Unknown StoreID {store_id}'}
 
-    response_body = {
-        'application/json': {
-            'body': json.dumps(body)
+        if not isinstance(body, EncodedBody):
+            with metrics.timer('EncodeTime'):
+                body = json.dumps(body)
+        response_body = {
+            'application/json': {
+                'body': body
+            }
         }
-    }
-        
-    action_response = {
-        'actionGroup': event['actionGroup'],
-        'apiPath': event['apiPath'],
-        'httpMethod': event['httpMethod'],
-        'httpStatusCode': 200,
-        'responseBody': response_body
-    }
-
-    responses.append(action_response)
-    
-    api_response = {
-        'messageVersion': '1.0', 
-        'response': action_response}
-        
-    return api_response
-    
-    
\ No newline at end of file
+        metrics.add('ResponseBytes', len(body))
+
+        action_response = {
+            'actionGroup': event['actionGroup'],
+            'apiPath': event['apiPath'],
+            'httpMethod': event['httpMethod'],
+            'httpStatusCode': status_code,
+            'responseBody': response_body
+        }
+
+        responses.append(action_response)
+
+        api_response = {
+            'messageVersion': '1.0', 
+            'response': action_response}
+
+        stores.evict(db)
+        return api_response
+    except Exception:
+        status_code = 500
+        raise
+    finally:
+        #also recorded when the invocation fails, e.g. on an S3 error or a CommitConflictError
+        metrics.add('TotalTime', (time.perf_counter() - begin) * 1000)
+        if metrics_sample_rate > 0 and (cold_start or random.random() < metrics_sample_rate):
+            #unknown paths share one dimension value so bad requests cannot create new metrics
+            known = any(path == api_path for path, _ in routes)
+            metrics.emit(api_path if known else 'unknown', status_code, cold_start)
+        cold_start = False
+        metrics.reset()
+
+
+#Seeds the kv backend's DynamoDB table from a local data file:
+#python lambda_retail_agent.py seed-kv <table> <data file> [<StoreID>]
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5) or sys.argv[1] != 'seed-kv':
+        sys.exit('usage: python lambda_retail_agent.py seed-kv <table> <data file> [<StoreID>]')
+    seed_key_value_table(*sys.argv[2:])
@@ -0,0 +1,833 @@
+import argparse
+import hashlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+# Local benchmark for lambda_retail_agent.py. The Lambda module is imported against an
+# in-memory S3 stand-in with simulated request latency and bandwidth, so cold and warm
+# invocations can be timed without deploying anything.
+
+LAMBDA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda_retail_agent.py')
+BUCKET = 'bench-bucket'
+DB_KEY = 'demo_csbot_db'
+
+ACTIVITIES = ['Running', 'Hiking', 'Walking', 'Tennis', 'Basketball', 'Trail Running', 'Training', 'Casual']
+COLORS = ['Black', 'White', 'Red', 'Blue', 'Grey', 'Green', 'Orange']
+FIRST_NAMES = ['John', 'Jane', 'Alex', 'Maria', 'Wei', 'Priya', 'Omar', 'Sofia', 'Liam', 'Ava']
+LAST_NAMES = ['Doe', 'Smith', 'Garcia', 'Chen', 'Patel', 'Khan', 'Rossi', 'Nguyen', 'Brown', 'Silva']
+
+
+def client_error(status, code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+
+class FakeBody:
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._stream.read(amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class FakePaginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+
+# The real S3 request model, which the Lambda checks for conditional write support. Loaded on first
+# access: importing botocore.session pulls in botocore.client, which must stay unimported until
+# RouteBotocoreCalls is installed for the coldstart child.
+class FakeClientMeta:
+    def __init__(self):
+        self._service_model = None
+
+    @property
+    def service_model(self):
+        if self._service_model is None:
+            import botocore.session
+            self._service_model = botocore.session.get_session().get_service_model('s3')
+        return self._service_model
+
+
+# In-memory S3 stand-in implementing the calls the Lambda makes. Every request sleeps for
+# latency_ms plus the time the payload takes at bandwidth_mbps, and is counted per operation.
+class FakeS3:
+    def __init__(self, latency_ms=20.0, bandwidth_mbps=400.0):
+        self.latency = latency_ms / 1000.0
+        self.bytes_per_second = bandwidth_mbps * 1024 * 1024 / 8
+        self.objects = {}
+        self.calls = {}
+        self.bytes_transferred = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.meta = FakeClientMeta()
+
+    def _request(self, operation, size=0):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.bytes_transferred += size
+        delay = self.latency + size / self.bytes_per_second
+        time.sleep(delay)
+        self.local.elapsed = self.time_spent() + delay
+
+    # Simulated S3 time spent by the calling thread so far, used for per-phase breakdowns
+    def time_spent(self):
+        return getattr(self.local, 'elapsed', 0.0)
+
+    def _store(self, key, data):
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        self.objects[key] = {'Body': data, 'ETag': etag, 'LastModified': datetime.now(timezone.utc)}
+        return etag
+
+    # Supports the conditional writes the Lambda relies on: IfNoneMatch='*' (create only)
+    # and IfMatch=<etag> (replace only that version); a lost race raises 412 PreconditionFailed
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, IfMatch=None, **kwargs):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self._request('PutObject', len(data))
+        with self.lock:
+            current = self.objects.get(Key)
+            if IfNoneMatch == '*' and current is not None:
+                raise client_error(412, 'PreconditionFailed', 'PutObject')
+            if IfMatch is not None and (current is None or current['ETag'] != IfMatch):
+                raise client_error(412, 'PreconditionFailed', 'PutObject')
+            return {'ETag': self._store(Key, data)}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        with self.lock:
+            obj = self.objects.get(Key)
+        if obj is None:
+            self._request('GetObject')
+            raise client_error(404, 'NoSuchKey', 'GetObject')
+        if IfNoneMatch is not None and IfNoneMatch == obj['ETag']:
+            self._request('GetObject')
+            raise client_error(304, '304', 'GetObject')
+        self._request('GetObject', len(obj['Body']))
+        return {'Body': FakeBody(obj['Body']), 'ETag': obj['ETag'], 'ContentLength': len(obj['Body'])}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', **kwargs):
+        self._request('ListObjectsV2')
+        with self.lock:
+            keys = sorted(k for k in self.objects if k.startswith(Prefix) and k > StartAfter)
+            contents = [{'Key': k, 'ETag': self.objects[k]['ETag'], 'LastModified': self.objects[k]['LastModified']}
+                        for k in keys]
+        return {'Contents': contents, 'KeyCount': len(keys)}
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def delete_objects(self, Bucket, Delete):
+        self._request('DeleteObjects')
+        with self.lock:
+            for obj in Delete['Objects']:
+                self.objects.pop(obj['Key'], None)
+        return {}
+
+    def download_file(self, Bucket, Key, Filename):
+        obj = self.get_object(Bucket, Key)
+        with open(Filename, 'wb') as fp:
+            fp.write(obj['Body'].read())
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as fp:
+            self.put_object(Bucket, Key, fp.read())
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.bytes_transferred = 0
+
+
+# Builds a database with the tables and columns of demo_csbot_db at the requested scale
+def generate_db(path, customers=1000, shoes=50, orders=1000, seed=7):
+    rnd = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE CustomerInfo (CustomerID INTEGER PRIMARY KEY, CustomerName TEXT, Addr1 TEXT, Addr2 TEXT,
+            City TEXT, State TEXT, Zipcode TEXT, PreferredActivity TEXT, ShoeSize INTEGER, OtherInfo TEXT);
+        CREATE TABLE ShoeInventory (ShoeID INTEGER PRIMARY KEY, BestFitActivity TEXT, StyleDesc TEXT,
+            ShoeColors TEXT, Price TEXT, InvCount INTEGER);
+        CREATE TABLE OrderDetails (OrderID INTEGER PRIMARY KEY AUTOINCREMENT, OrderDate TEXT, ShoeID INTEGER,
+            CustomerID INTEGER);
+    ''')
+    conn.execute('INSERT INTO CustomerInfo VALUES (1, "John Doe", "123 Main St", "", "Seattle", "WA", "98101", '
+                 '"Running", 10, "Likes trail running")')
+    conn.executemany('INSERT INTO CustomerInfo VALUES (?,?,?,?,?,?,?,?,?,?)', (
+        (i, f'{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)} {i}', f'{i} Elm St', '', 'Springfield', 'IL',
+         f'{60000 + i % 1000:05d}', rnd.choice(ACTIVITIES), rnd.randint(5, 14), 'Synthetic customer')
+        for i in range(2, customers + 1)))
+    conn.executemany('INSERT INTO ShoeInventory VALUES (?,?,?,?,?,?)', (
+        (i, rnd.choice(ACTIVITIES), f'Synthetic shoe model {i}', ', '.join(rnd.sample(COLORS, 2)),
+         f'{rnd.randint(40, 220)}.00', rnd.randint(50, 500))
+        for i in range(1, shoes + 1)))
+    conn.executemany('INSERT INTO OrderDetails (OrderDate, ShoeID, CustomerID) VALUES (?,?,?)', (
+        (f'2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}', rnd.randint(1, shoes), rnd.randint(1, customers))
+        for _ in range(orders)))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def seed_bucket(s3, db_path):
+    with open(db_path, 'rb') as fp:
+        s3._store(DB_KEY, fp.read())
+
+
+# Imports a fresh, independent copy of the Lambda module (one per simulated execution
+# environment) whose boto3 S3 client is the given stand-in
+def load_lambda(s3, local_path, name='lambda_retail_agent_bench_instance', **extra_env):
+    env = {'BUCKET_NAME': BUCKET, 'LOCAL_DB_PATH': local_path, 'AWS_DEFAULT_REGION': 'us-east-1', 'METRICS_SAMPLE_RATE': '0'}
+    env.update({k: str(v) for k, v in extra_env.items()})
+    import boto3
+    with mock.patch.dict(os.environ, env), mock.patch.object(boto3, 'client', return_value=s3):
+        spec = importlib.util.spec_from_file_location(name, LAMBDA_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        #the data file is fetched on a background thread that creates the client, wait for it while patched
+        module.prefetch_thread.join()
+    return module
+
+
+def make_event(api_path, **params):
+    return {
+        'actionGroup': 'RetailManagementActionGroup',
+        'apiPath': api_path,
+        'httpMethod': 'GET',
+        'parameters': [{'name': k, 'type': 'string', 'value': str(v)} for k, v in params.items()],
+    }
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    ms = [s * 1000 for s in samples]
+    return {'n': len(ms), 'mean': statistics.mean(ms), 'p50': percentile(ms, 50), 'p95': percentile(ms, 95),
+            'p99': percentile(ms, 99), 'max': max(ms)}
+
+
+def report(label, samples):
+    stats = summarize(samples)
+    print(f'{label:<28} n={stats["n"]:<5} mean={stats["mean"]:8.2f}ms  p50={stats["p50"]:8.2f}ms  '
+          f'p95={stats["p95"]:8.2f}ms  p99={stats["p99"]:8.2f}ms  max={stats["max"]:8.2f}ms')
+    return stats
+
+
+# Cold start (module import incl. first download) vs warm invocations that only revalidate
+def bench_sync(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        db_path = generate_db(os.path.join(workdir, 'seed.db'), args.customers, args.shoes, args.orders)
+        print(f'database size: {os.path.getsize(db_path) / 1024 / 1024:.2f} MiB, '
+              f'S3 latency {args.latency_ms}ms, bandwidth {args.bandwidth_mbps} Mbit/s')
+        s3 = FakeS3(args.latency_ms, args.bandwidth_mbps)
+        seed_bucket(s3, db_path)
+
+        cold, warm_reads, orders, post_order_reads = [], [], [], []
+        for i in range(args.repeat):
+            local_path = os.path.join(workdir, f'cold_{i}.db')
+            start = time.perf_counter()
+            module = load_lambda(s3, local_path, f'bench_cold_{i}')
+            module.lambda_handler(make_event('/check_inventory'), None)
+            cold.append(time.perf_counter() - start)
+            module.db.close()
+
+        module = load_lambda(s3, os.path.join(workdir, 'warm.db'), 'bench_warm')
+        module.lambda_handler(make_event('/check_inventory'), None)
+        s3.reset_counters()
+        for _ in range(args.invocations):
+            start = time.perf_counter()
+            module.lambda_handler(make_event('/customer/{CustomerName}', CustomerName='John'), None)
+            warm_reads.append(time.perf_counter() - start)
+        warm_calls = dict(s3.calls)
+
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            module.lambda_handler(make_event('/place_order', ShoeID=1, CustomerID=1), None)
+            orders.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            module.lambda_handler(make_event('/check_inventory'), None)
+            post_order_reads.append(time.perf_counter() - start)
+        module.db.close()
+
+        report('cold start + first read', cold)
+        report('warm read', warm_reads)
+        report('order', orders)
+        report('read after order', post_order_reads)
+        print(f'S3 calls during warm reads: {warm_calls}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Order latency and bytes written per order at growing database sizes
+def bench_journal(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        for scale in (args.customers // 10, args.customers // 2, args.customers):
+            db_path = generate_db(os.path.join(workdir, f'seed_{scale}.db'), scale, args.shoes, scale)
+            s3 = FakeS3(args.latency_ms, args.bandwidth_mbps)
+            seed_bucket(s3, db_path)
+            module = load_lambda(s3, os.path.join(workdir, f'journal_{scale}.db'), f'bench_journal_{scale}')
+            module.lambda_handler(make_event('/check_inventory'), None)
+            s3.reset_counters()
+            orders = []
+            for _ in range(args.invocations):
+                start = time.perf_counter()
+                module.lambda_handler(make_event('/place_order', ShoeID=1, CustomerID=1), None)
+                orders.append(time.perf_counter() - start)
+            module.db.close()
+            report(f'order @ {os.path.getsize(db_path) / 1024 / 1024:.1f} MiB', orders)
+            print(f'    {s3.bytes_transferred / len(orders) / 1024:.1f} KiB transferred per order, calls {s3.calls}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Customer lookup latency by match tier at the configured number of customers
+def bench_lookup(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        db_path = generate_db(os.path.join(workdir, 'seed.db'), args.customers, args.shoes, 0)
+        s3 = FakeS3(0, 100000)
+        seed_bucket(s3, db_path)
+        start = time.perf_counter()
+        module = load_lambda(s3, os.path.join(workdir, 'lookup.db'), 'bench_lookup')
+        print(f'{args.customers} customers, cold start incl. index build {time.perf_counter() - start:.2f}s')
+        module.load_data()
+        slow = []
+        for label, name in (('exact', 'John Doe'), ('prefix', 'Maria Chen'), ('substring', 'ia Che'),
+                            ('fuzzy', 'Jhon Doe'), ('no match', 'Zebulon'), ('short', 'Wu')):
+            module.return_customer_info(name)  # compiles the tier's statements
+            samples = []
+            for _ in range(args.invocations):
+                begin = time.perf_counter()
+                module.return_customer_info(name)
+                samples.append(time.perf_counter() - begin)
+            stats = report(f'{label} ({name})', samples)
+            if stats['p50'] > args.target_ms:
+                slow.append(f'{label}: p50 {stats["p50"]:.2f}ms')
+        module.db.close()
+        if slow:
+            raise SystemExit(f'FAILED: lookups over {args.target_ms}ms at {args.customers} customers: {", ".join(slow)}')
+        print(f'OK: every match tier within {args.target_ms}ms at p50')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# The three API paths as they were written before the data-access layer: string-built SQL and
+# per-column index loops over cursor.description, on a default connection
+def legacy_customer_info(cursor, custName):
+    query = 'SELECT customerId, customerName, Addr1, Addr2, City, State, Zipcode, PreferredActivity, ShoeSize, OtherInfo from CustomerInfo where customerName like "%' + custName + '%"'
+    cursor.execute(query)
+    resp = cursor.fetchall()
+    names = [description[0] for description in cursor.description]
+    valDict = {}
+    index = 0
+    for name in names:
+        valDict[name] = resp[0][index]
+        index = index + 1
+    return valDict
+
+
+def legacy_shoe_inventory(cursor):
+    cursor.execute('SELECT ShoeID, BestFitActivity, StyleDesc, ShoeColors, Price, InvCount from ShoeInventory')
+    resp = cursor.fetchall()
+    names = [description[0] for description in cursor.description]
+    valDict = []
+    interimDict = {}
+    index = 0
+    for item in resp:
+        for name in names:
+            interimDict[name] = item[index]
+            index = index + 1
+        index = 0
+        valDict.append(interimDict)
+        interimDict = {}
+    return valDict
+
+
+def legacy_place_order(conn, ssId, custId):
+    cursor = conn.cursor()
+    cursor.execute('Update ShoeInventory set InvCount = InvCount - 1 where ShoeID = ' + str(ssId))
+    today = time.strftime('%Y-%m-%d')
+    cursor.execute('INSERT INTO OrderDetails (orderdate, shoeId, CustomerId) VALUES ("' + today + '",' + str(ssId) + ',' + str(custId) + ')')
+    conn.commit()
+
+
+# Before/after microbenchmark of the SQL side of the three API paths (S3 excluded)
+def bench_dal(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        db_path = generate_db(os.path.join(workdir, 'seed.db'), args.customers, args.shoes, args.orders)
+        legacy_path = os.path.join(workdir, 'legacy.db')
+        shutil.copy(db_path, legacy_path)
+        legacy = sqlite3.connect(legacy_path)
+        cursor = legacy.cursor()
+        s3 = FakeS3(0, 100000)
+        seed_bucket(s3, db_path)
+        module = load_lambda(s3, os.path.join(workdir, 'dal.db'), 'bench_dal')
+        module.load_data()
+
+        def timed(fn):
+            samples = []
+            for _ in range(args.invocations):
+                begin = time.perf_counter()
+                fn()
+                samples.append(time.perf_counter() - begin)
+            return samples
+
+        report('before: customer', timed(lambda: legacy_customer_info(cursor, 'John Doe')))
+        report('after:  customer', timed(lambda: module.return_customer_info('John Doe')))
+        report('before: inventory', timed(lambda: legacy_shoe_inventory(cursor)))
+        report('after:  inventory', timed(lambda: module.return_shoe_inventory()))
+        report('before: order', timed(lambda: legacy_place_order(legacy, 1, 1)))
+        order_ops = [{'op': 'order', 'OrderDate': '2024-01-01', 'ShoeID': 1, 'CustomerID': 1}]
+        report('after:  order', timed(lambda: module.db.append(order_ops)))
+        legacy.close()
+        module.db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def read_counts(path):
+    conn = sqlite3.connect(path)
+    inventory = dict(conn.execute('SELECT ShoeID, InvCount FROM ShoeInventory'))
+    orders = conn.execute('SELECT COUNT(*) FROM OrderDetails').fetchone()[0]
+    conn.close()
+    return inventory, orders
+
+
+# Several simulated execution environments place orders concurrently against one bucket.
+# Afterwards a fresh instance must see every decrement and every OrderDetails row.
+def stress_concurrency(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        db_path = generate_db(os.path.join(workdir, 'seed.db'), 1000, args.shoes, 100)
+        start_inventory, start_orders = read_counts(db_path)
+        s3 = FakeS3(args.latency_ms, args.bandwidth_mbps)
+        seed_bucket(s3, db_path)
+        instances = [load_lambda(s3, os.path.join(workdir, f'instance_{i}.db'), f'bench_stress_{i}',
+                                 JOURNAL_COMPACT_THRESHOLD=args.compact_threshold, MAX_COMMIT_ATTEMPTS=1000,
+                                 JOURNAL_RETENTION_SECONDS=args.retention_seconds,
+                                 WRITE_BEHIND_SECONDS=args.write_behind_seconds)
+                     for i in range(args.threads)]
+        placed = [[] for _ in instances]
+        errors = []
+
+        def worker(index):
+            rnd = random.Random(index)
+            module = instances[index]
+            try:
+                for _ in range(args.invocations):
+                    shoe = rnd.choice(list(start_inventory))
+                    module.lambda_handler(make_event('/place_order', ShoeID=shoe, CustomerID=1), None)
+                    placed[index].append(shoe)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(instances))]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for module in instances:
+            #what the flush extension does before an execution environment is frozen
+            module.db.flush_all()
+            module.db.close()
+        if errors:
+            raise errors[0]
+
+        verify = load_lambda(s3, os.path.join(workdir, 'verify.db'), 'bench_stress_verify')
+        verify.db.close()
+        end_inventory, end_orders = read_counts(os.path.join(workdir, 'verify.db'))
+        expected = dict(start_inventory)
+        for shoes in placed:
+            for shoe in shoes:
+                expected[shoe] -= 1
+        total = sum(len(shoes) for shoes in placed)
+        print(f'{total} orders from {len(instances)} instances in {elapsed:.2f}s, S3 calls {s3.calls}')
+        print(f'OrderDetails rows: {start_orders} -> {end_orders} (expected {start_orders + total})')
+        mismatched = {shoe: (end_inventory[shoe], expected[shoe]) for shoe in expected if end_inventory[shoe] != expected[shoe]}
+        if end_orders != start_orders + total or mismatched:
+            raise SystemExit(f'FAILED: inventory mismatches (actual, expected): {mismatched}')
+        print('OK: InvCount and order counts add up')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Several simulated execution environments take orders through the kv storage backend, all sharing
+# one in-process key-value store, for more pairs than are in stock. No shoe may be oversold and
+# every successful order must have exactly one order item.
+def stress_key_value(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        db_path = generate_db(os.path.join(workdir, 'seed.db'), 1000, args.shoes, 100)
+        conn = sqlite3.connect(db_path)
+        conn.execute('UPDATE ShoeInventory SET InvCount = ?', (args.stock,))
+        conn.commit()
+        conn.close()
+        start_inventory, _ = read_counts(db_path)
+        s3 = FakeS3(args.latency_ms, args.bandwidth_mbps)
+        seed_bucket(s3, db_path)
+        instances = [load_lambda(s3, os.path.join(workdir, f'instance_{i}.db'), f'bench_kv_{i}', RETAIL_STORE_BACKEND='kv',
+                                 KV_TABLE_NAME=':memory:')
+                     for i in range(args.threads)]
+        kv = instances[0].InMemoryKeyValue()
+        with instances[0].db.lock:
+            instances[0].load_key_value(kv, instances[0].db.key, instances[0].db.reader())
+        for module in instances:
+            module.backend = module.KeyValueBackend(kv)
+        placed = [[] for _ in instances]
+        errors = []
+
+        def worker(index):
+            rnd = random.Random(index)
+            module = instances[index]
+            try:
+                for _ in range(args.invocations):
+                    shoe = rnd.choice(list(start_inventory))
+                    response = module.lambda_handler(make_event('/place_order', ShoeID=shoe, CustomerID=1), None)
+                    if json.loads(response['response']['responseBody']['application/json']['body']) == 1:
+                        placed[index].append(shoe)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(instances))]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+
+        key = instances[0].db.key
+        end_inventory = {shoe['ShoeID']: shoe['InvCount'] for shoe in kv.items(f'{key}/shoe')}
+        orders = kv.items(f'{key}/order')
+        expected = dict(start_inventory)
+        for shoes in placed:
+            for shoe in shoes:
+                expected[shoe] -= 1
+        total = sum(len(shoes) for shoes in placed)
+        print(f'{total} of {args.threads * args.invocations} orders placed from {len(instances)} instances in {elapsed:.2f}s')
+        mismatched = {shoe: (end_inventory[shoe], expected[shoe]) for shoe in expected if end_inventory[shoe] != expected[shoe]}
+        oversold = {shoe: count for shoe, count in end_inventory.items() if count < 0}
+        if mismatched or oversold or len(orders) != total:
+            raise SystemExit(f'FAILED: {len(orders)} order items, oversold {oversold}, mismatches (actual, expected): {mismatched}')
+        print(f'OK: {len(orders)} order items, no shoe oversold')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Synthetic action-group events covering every operation, in a fixed mix: mostly reads,
+# some filtered inventory pages and orders, and the occasional batch
+def synthetic_events(count, customers, shoes, seed=11):
+    rnd = random.Random(seed)
+    events = []
+    for _ in range(count):
+        roll = rnd.random()
+        if roll < 0.35:
+            name = 'John Doe' if rnd.random() < 0.5 else f'{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}'
+            events.append(make_event('/recommend/{CustomerName}' if roll < 0.05 else '/customer/{CustomerName}',
+                                     CustomerName=name))
+        elif roll < 0.60:
+            events.append(make_event('/check_inventory'))
+        elif roll < 0.80:
+            events.append(make_event('/check_inventory', Activity=rnd.choice(ACTIVITIES), InStockOnly='true', Limit=5))
+        elif roll < 0.92:
+            events.append(make_event('/place_order', ShoeID=rnd.randint(1, shoes), CustomerID=rnd.randint(1, customers)))
+        elif roll < 0.95:
+            items = [{'ShoeID': rnd.randint(1, shoes), 'Quantity': rnd.randint(1, 3)} for _ in range(rnd.randint(2, 4))]
+            event = make_event('/place_order')
+            event['httpMethod'] = 'POST'
+            event['requestBody'] = {'content': {'application/json': {'properties': [
+                {'name': 'CustomerID', 'type': 'int', 'value': str(rnd.randint(1, customers))},
+                {'name': 'Items', 'type': 'string', 'value': json.dumps(items)}]}}}
+            events.append(event)
+        else:
+            operations = [{'apiPath': '/customer/{CustomerName}', 'parameters': {'CustomerName': 'John Doe'}},
+                          {'apiPath': '/check_inventory', 'parameters': {'Activity': 'Running', 'Limit': 3}},
+                          {'apiPath': '/place_order', 'parameters': {'ShoeID': rnd.randint(1, shoes), 'CustomerID': 1}}]
+            event = make_event('/batch')
+            event['httpMethod'] = 'POST'
+            event['parameters'] = []
+            event['requestBody'] = {'content': {'application/json': {'properties': [
+                {'name': 'operations', 'type': 'string', 'value': json.dumps(operations)}]}}}
+            events.append(event)
+    return events
+
+
+def load_events(path):
+    with open(path, 'r') as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def event_class(event):
+    return 'order' if event['apiPath'] in ('/place_order', '/batch') else 'read'
+
+
+# Times one invocation split into phases: sync (snapshot revalidation and journal replay),
+# dispatch (the operation itself) minus the S3 calls it made, s3 (simulated S3 time inside
+# dispatch) and respond (response encoding and assembly)
+def timed_invocation(module, s3, event):
+    phases = {}
+    load_data, dispatch = module.load_data, module.dispatch
+
+    def timed_load_data(*args, **kwargs):
+        begin = time.perf_counter()
+        load_data(*args, **kwargs)
+        phases['sync'] = time.perf_counter() - begin
+
+    def timed_dispatch(*args, **kwargs):
+        begin, s3_begin = time.perf_counter(), s3.time_spent()
+        try:
+            return dispatch(*args, **kwargs)
+        finally:
+            phases['s3'] = s3.time_spent() - s3_begin
+            phases['dispatch'] = time.perf_counter() - begin - phases['s3']
+
+    module.load_data, module.dispatch = timed_load_data, timed_dispatch
+    try:
+        begin = time.perf_counter()
+        module.lambda_handler(event, None)
+        total = time.perf_counter() - begin
+    finally:
+        module.load_data, module.dispatch = load_data, dispatch
+    phases['respond'] = max(0.0, total - sum(phases.values()))
+    return total, phases
+
+
+# Replays recorded (--events, one Lambda event per line) or synthetic events against one warm
+# execution environment at a target rate, after measuring cold inits on fresh environments.
+# Reports p50/p95/p99 per class and phase; --save/--baseline turn it into a regression gate on
+# the per-class totals (individual phases are too small to compare reliably).
+def bench_replay(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        db_path = generate_db(os.path.join(workdir, 'seed.db'), args.customers, args.shoes, args.orders)
+        s3 = FakeS3(args.latency_ms, args.bandwidth_mbps)
+        seed_bucket(s3, db_path)
+        events = load_events(args.events) if args.events else synthetic_events(args.invocations, args.customers, args.shoes)
+        env = dict(setting.split('=', 1) for setting in args.env)
+        print(f'database {os.path.getsize(db_path) / 1024 / 1024:.1f} MiB, {len(events)} events at '
+              f'{args.rate or "max"} events/s, S3 latency {args.latency_ms}ms')
+
+        results = {}
+        cold_init, cold_first = [], []
+        for i in range(args.repeat):
+            begin = time.perf_counter()
+            module = load_lambda(s3, os.path.join(workdir, f'cold_{i}.db'), f'bench_replay_cold_{i}', **env)
+            cold_init.append(time.perf_counter() - begin)
+            total, _ = timed_invocation(module, s3, events[0])
+            cold_first.append(total)
+            module.db.close()
+        print('-- cold start')
+        results['cold init'] = report('init (import + load)', cold_init)
+        results['cold first invocation'] = report('first invocation', cold_first)
+
+        module = load_lambda(s3, os.path.join(workdir, 'warm.db'), 'bench_replay_warm', **env)
+        timed_invocation(module, s3, events[0])
+        samples = {'read': [], 'order': []}
+        phase_samples = {'read': {}, 'order': {}}
+        interval = 1.0 / args.rate if args.rate else 0.0
+        lag = []
+        start = time.perf_counter()
+        for index, event in enumerate(events):
+            if interval:
+                #without a target rate every event is due at once, so there is no schedule to fall behind
+                due = start + index * interval
+                now = time.perf_counter()
+                if now < due:
+                    time.sleep(due - now)
+                else:
+                    lag.append(now - due)
+            total, phases = timed_invocation(module, s3, event)
+            samples[event_class(event)].append(total)
+            for phase, value in phases.items():
+                phase_samples[event_class(event)].setdefault(phase, []).append(value)
+        elapsed = time.perf_counter() - start
+        module.db.flush_all()
+        module.db.close()
+
+        for kind in ('read', 'order'):
+            if not samples[kind]:
+                continue
+            print(f'-- warm {kind}s')
+            results[f'warm {kind}'] = report(f'{kind} total', samples[kind])
+            for phase in ('sync', 'dispatch', 's3', 'respond'):
+                results[f'warm {kind} {phase}'] = report(f'  {phase}', phase_samples[kind][phase])
+        schedule = f', behind schedule for {len(lag)} events' if interval else ''
+        print(f'achieved {len(events) / elapsed:.1f} events/s{schedule}, S3 calls {s3.calls}')
+
+        if args.save:
+            with open(args.save, 'w') as fp:
+                json.dump(results, fp, indent=2)
+        if args.baseline:
+            with open(args.baseline, 'r') as fp:
+                baseline = json.load(fp)
+            regressions = [f'{name}: p95 {results[name]["p95"]:.2f}ms vs {stats["p95"]:.2f}ms'
+                           for name, stats in baseline.items()
+                           if name in results and not name.endswith(('sync', 'dispatch', 's3', 'respond')) and results[name]['p95'] > stats['p95'] * (1 + args.tolerance)]
+            if regressions:
+                raise SystemExit('REGRESSION:\n  ' + '\n  '.join(regressions))
+            print(f'OK: no p95 regression beyond {args.tolerance:.0%} of {args.baseline}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Routes the API calls of every real botocore client to the stand-in as soon as botocore.client
+# is imported, so a cold start still pays for importing boto3 and creating the client
+class RouteBotocoreCalls(importlib.abc.MetaPathFinder):
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def find_spec(self, name, path, target=None):
+        if name != 'botocore.client':
+            return None
+        spec = importlib.machinery.PathFinder.find_spec(name, path)
+        exec_module, s3 = spec.loader.exec_module, self.s3
+
+        def exec_and_route(module):
+            exec_module(module)
+            from botocore import xform_name
+            module.BaseClient._make_api_call = lambda client, operation, params: getattr(s3, xform_name(operation))(**params)
+
+        spec.loader.exec_module = exec_and_route
+        return spec
+
+
+# Runs in a fresh interpreter: imports the Lambda module (the init phase) and handles one event,
+# printing both timings as JSON. Nothing from boto3 is imported before the module does it.
+def coldstart_child(args):
+    s3 = FakeS3(args.latency_ms, args.bandwidth_mbps)
+    seed_bucket(s3, args.db)
+    sys.meta_path.insert(0, RouteBotocoreCalls(s3))
+    os.environ.update({'BUCKET_NAME': BUCKET, 'LOCAL_DB_PATH': args.local, 'AWS_DEFAULT_REGION': 'us-east-1',
+                       'OPENAPI_SCHEMA_PATH': os.path.join(os.path.dirname(LAMBDA_PATH), 'retail-agent-openapi.json')})
+    if args.prewarm:
+        os.environ['PREWARM'] = 'true'
+    begin = time.perf_counter()
+    spec = importlib.util.spec_from_file_location('lambda_retail_agent', args.module)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    init = time.perf_counter() - begin
+    begin = time.perf_counter()
+    module.lambda_handler(make_event('/customer/{CustomerName}', CustomerName='John Doe'), None)
+    first = time.perf_counter() - begin
+    print(json.dumps({'init': init, 'first': first}))
+
+
+# Cold start of the current module (and of --compare, e.g. an older revision saved with git show)
+# measured in fresh interpreters: init phase, first invocation, and the two together
+def bench_coldstart(args):
+    workdir = tempfile.mkdtemp(prefix='retail_bench_')
+    try:
+        db_path = generate_db(os.path.join(workdir, 'seed.db'), args.customers, args.shoes, args.orders)
+        print(f'database {os.path.getsize(db_path) / 1024 / 1024:.1f} MiB, S3 latency {args.latency_ms}ms')
+        variants = [('current', LAMBDA_PATH, False), ('current PREWARM', LAMBDA_PATH, True)]
+        if args.compare:
+            variants.insert(0, ('compare', os.path.abspath(args.compare), False))
+        for variant, (label, module_path, prewarm) in enumerate(variants):
+            samples = {'init': [], 'first': [], 'total': []}
+            for i in range(args.repeat):
+                command = [sys.executable, os.path.abspath(__file__), '--latency-ms', str(args.latency_ms),
+                           '--bandwidth-mbps', str(args.bandwidth_mbps), 'coldstart-child', '--module', module_path,
+                           '--db', db_path, '--local', os.path.join(workdir, f'cold_{variant}_{i}.db')]
+                if prewarm:
+                    command.append('--prewarm')
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                timings = json.loads(output.strip().splitlines()[-1])
+                samples['init'].append(timings['init'])
+                samples['first'].append(timings['first'])
+                samples['total'].append(timings['init'] + timings['first'])
+            print(f'-- {label} ({module_path})')
+            for phase in ('init', 'first', 'total'):
+                report(f'  {phase}', samples[phase])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local benchmarks for lambda_retail_agent.py')
+    parser.add_argument('--customers', type=int, default=200000)
+    parser.add_argument('--shoes', type=int, default=200)
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=400.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--invocations', type=int, default=50)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('sync', help='cold vs warm latency of the conditional snapshot sync').set_defaults(func=bench_sync)
+    sub.add_parser('journal', help='order latency as the database grows').set_defaults(func=bench_journal)
+    sub.add_parser('dal', help='SQL cost of the three API paths before/after the data-access layer').set_defaults(func=bench_dal)
+    lookup = sub.add_parser('lookup', help='customer name lookup latency')
+    lookup.add_argument('--target-ms', type=float, default=1.0, help='largest p50 allowed for any match tier')
+    lookup.set_defaults(func=bench_lookup)
+    replay = sub.add_parser('replay', help='replay action-group events and report latency percentiles by phase')
+    replay.add_argument('--events', help='file with one recorded Lambda event (JSON) per line; synthetic if omitted')
+    replay.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='environment variable for the Lambda module, e.g. WRITE_BEHIND_SECONDS=0.2')
+    replay.add_argument('--rate', type=float, default=0, help='target events per second (0 = as fast as possible)')
+    replay.add_argument('--save', help='write the percentiles to this JSON file')
+    replay.add_argument('--baseline', help='fail if any p95 exceeds the one saved in this JSON file')
+    replay.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 regression against the baseline')
+    replay.set_defaults(func=bench_replay)
+    coldstart = sub.add_parser('coldstart', help='init-phase and first-invocation time in fresh interpreters')
+    coldstart.add_argument('--compare', help='another lambda_retail_agent.py to measure alongside the current one')
+    coldstart.set_defaults(func=bench_coldstart)
+    child = sub.add_parser('coldstart-child', help=argparse.SUPPRESS)
+    child.add_argument('--module', required=True)
+    child.add_argument('--db', required=True)
+    child.add_argument('--local', required=True)
+    child.add_argument('--prewarm', action='store_true')
+    child.set_defaults(func=coldstart_child)
+    stress = sub.add_parser('stress', help='concurrent writers must not lose orders')
+    stress.add_argument('--threads', type=int, default=8)
+    stress.add_argument('--compact-threshold', type=int, default=25)
+    stress.add_argument('--retention-seconds', type=float, default=1.0)
+    stress.add_argument('--write-behind-seconds', type=float, default=0.0)
+    stress.set_defaults(func=stress_concurrency)
+    kv = sub.add_parser('kv', help='concurrent orders through the key-value backend must not oversell')
+    kv.add_argument('--threads', type=int, default=8)
+    kv.add_argument('--stock', type=int, default=10, help='pairs in stock per shoe')
+    kv.set_defaults(func=stress_key_value)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
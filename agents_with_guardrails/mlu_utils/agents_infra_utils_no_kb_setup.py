@@ -46,6 +46,23 @@ lambda_client = boto3.client('lambda')
 from pathlib import Path
 
 
+# The SDK the Lambda function is packaged with: the Python runtime's own boto3 can predate S3 conditional
+# writes (PutObject IfNoneMatch/IfMatch), which the function's order journal relies on
+lambda_sdk_packages = ('boto3', 'botocore', 's3transfer')
+
+
+# Adds the installed copy of a package to a Lambda zip, at the top level where the runtime imports it from
+def add_package_to_zip(z, package_name):
+    package = __import__(package_name)
+    package_dir = os.path.dirname(package.__file__)
+    root = os.path.dirname(package_dir)
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        dirnames[:] = [d for d in dirnames if d != '__pycache__']
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            z.write(path, os.path.relpath(path, root))
+
+
 def check_for_kb_files():
     csbot_db_file_name = f"retail-kb/demo_csbot_db"
     csbot_db_exists = False
@@ -71,7 +88,10 @@ def generate_prefix_for_agent_infra():
     return prefix_infra, prefix_iam
 
 
-def setup_agent_infrastructure(schema_filename, kb_db_file_uri, lambda_code_uri):
+# action_group_executor is the actionGroupExecutor to create the agent's action group with (returned as
+# infra_response["action_group_executor"]): the Lambda function by default, or e.g.
+# agents_utils.return_control_executor to run the operations in the notebook with a LocalActionGroup
+def setup_agent_infrastructure(schema_filename, kb_db_file_uri, lambda_code_uri, action_group_executor=None):
     
     # prefix and suffix names
     prefix_infra, prefix_iam = generate_prefix_for_agent_infra()
@@ -208,10 +228,14 @@ def setup_agent_infrastructure(schema_filename, kb_db_file_uri, lambda_code_uri)
     )
     '''
 
-    # Package up the lambda function code
+    # Package up the lambda function code, with the Open API schema it builds its request router from and
+    # the SDK installed from requirements.txt
     s = BytesIO()
-    z = zipfile.ZipFile(s, 'w')
+    z = zipfile.ZipFile(s, 'w', zipfile.ZIP_DEFLATED)
     z.write(lambda_code_path)
+    z.write(schema_name, os.path.basename(schema_name))
+    for package_name in lambda_sdk_packages:
+        add_package_to_zip(z, package_name)
     z.close()
     zip_content = s.getvalue()
 
@@ -343,6 +367,7 @@ def setup_agent_infrastructure(schema_filename, kb_db_file_uri, lambda_code_uri)
         "schema_key": schema_key,
         "lambda_name": lambda_name,
         "lambda_function": lambda_function,
+        "action_group_executor": action_group_executor or {'lambda': lambda_function['FunctionArn']},
         "agent_bedrock_policy": agent_bedrock_policy,
         "agent_s3_schema_policy": agent_s3_schema_policy,
         "agent_role_name": agent_role_name,
@@ -377,9 +402,7 @@ def cleanup_infrastructure(agent_action_group_response, lambda_name, lambda_func
         agentVersion='DRAFT',
         actionGroupId= action_group_id,
         actionGroupName=action_group_name,
-        actionGroupExecutor={
-            'lambda': lambda_function['FunctionArn']
-        },
+        actionGroupExecutor=agent_action_group_response['agentActionGroup'].get('actionGroupExecutor', {'lambda': lambda_function['FunctionArn']}),
         apiSchema={
             's3': {
                 's3BucketName': bucket_name,
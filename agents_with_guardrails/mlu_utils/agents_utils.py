@@ -6,6 +6,15 @@ import logging
 import json
 from IPython.display import JSON
 import os, shutil
+import importlib.util
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+from mlu_utils.trace_sink import TraceSink, trace_type
+from mlu_utils.trace_store import last_trace, open_trace_store
 
 logging.basicConfig(format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s', level=logging.ERROR)
 logger = logging.getLogger(__name__)
@@ -16,6 +25,209 @@ def clean_up_trace_files(trace_file_path):
         shutil.rmtree(trace_file_path)
     os.mkdir(trace_file_path)
 
+# Action group executor for agents whose operations run on the client: the agent returns control with
+# the API call instead of invoking Lambda, and invoke_agent_generate_response() runs it with a LocalActionGroup
+return_control_executor = {'customControl': 'RETURN_CONTROL'}
+
+
+# Runs the operations of lambda_retail_agent.py in this process, against a private copy of the local
+# data file (e.g. retail-kb/demo_csbot_db), for an agent created with return_control_executor.
+# Nothing goes to Lambda or S3, so a turn saves the Lambda round trip and evaluation runs always
+# start from the same data.
+class LocalActionGroup:
+    # Settings of the module pinned while it is imported, whatever the notebook's environment holds:
+    # no write-behind (which registers atexit and replaces the kernel's SIGTERM handler), no prewarm,
+    # the sqlite backend on the local copy only
+    pinned_env = {'WRITE_BEHIND_SECONDS': '0', 'PREWARM': 'false', 'RETAIL_STORE_BACKEND': 'sqlite',
+                  'DEFAULT_STORE': 'default', 'STORE_PREFETCH': '', 'METRICS_SAMPLE_RATE': '0'}
+    # without a bucket the module uses the local copy as its data file
+    unset_env = ('BUCKET_NAME', 'KV_TABLE_NAME', 'AWS_LAMBDA_RUNTIME_API')
+
+    def __init__(self, db_file, lambda_code_path='lambda_retail_agent.py', work_dir=None):
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix='local_action_group_')
+        local_db = os.path.join(self.work_dir, 'csbot.db')
+        shutil.copyfile(db_file, local_db)
+        env = dict(self.pinned_env, LOCAL_DB_PATH=local_db, STORE_DIR=os.path.join(self.work_dir, 'stores'))
+        # the module reads its settings from the environment when it is imported; restore the caller's after.
+        # Like any Lambda handler module it also sets the root logger to INFO, which would send every
+        # logger.info of the kernel to the notebook output, so the root level is restored as well and
+        # the messages of the import itself are held back.
+        saved = {name: os.environ.get(name) for name in list(env) + list(self.unset_env)}
+        root_level = logging.getLogger().level
+        disabled = logging.root.manager.disable
+        logging.disable(max(disabled, logging.INFO))
+        try:
+            os.environ.update(env)
+            for name in self.unset_env:
+                os.environ.pop(name, None)
+            spec = importlib.util.spec_from_file_location('local_action_group_' + os.path.basename(self.work_dir),
+                                                          lambda_code_path)
+            self.module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(self.module)
+        finally:
+            logging.disable(disabled)
+            logging.getLogger().setLevel(root_level)
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        self.invocations = []  # (apiPath, seconds) of every operation run
+        # the module handles one event at a time, like a Lambda execution environment
+        self.lock = threading.Lock()
+
+    # Runs one apiInvocationInput of a returnControl event, returns the apiResult to send back
+    def invoke(self, api_input, session_id=None):
+        event = {
+            'messageVersion': '1.0',
+            'actionGroup': api_input['actionGroup'],
+            'apiPath': api_input['apiPath'],
+            'httpMethod': api_input['httpMethod'],
+            'parameters': api_input.get('parameters', []),
+            'requestBody': api_input.get('requestBody'),
+            'sessionId': session_id,
+            'sessionAttributes': {},
+        }
+        with self.lock:
+            start = time.perf_counter()
+            response = self.module.lambda_handler(event, None)['response']
+            self.invocations.append((api_input['apiPath'], time.perf_counter() - start))
+        logger.info(f"Ran {api_input['apiPath']} locally in {self.invocations[-1][1] * 1000:.1f} ms")
+        return response
+
+    def close(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+# Errors of invoke_agent, raised by the call or sent as an event of the completion stream, that are
+# worth retrying; the first two mean we are over the account's request rate
+throttling_error_codes = {'throttlingexception', 'servicequotaexceededexception'}
+retriable_error_codes = throttling_error_codes | {'internalserverexception', 'dependencyfailedexception',
+                                                  'badgatewayexception', 'serviceunavailableexception',
+                                                  'modelnotreadyexception'}
+
+
+# An error event of the completion stream, e.g. {'throttlingException': {'message': ...}}
+class AgentStreamError(Exception):
+    def __init__(self, code, event):
+        super().__init__(code, event)
+        self.code = code
+
+
+# Returns the lower-cased error code when the error is worth retrying, else None
+def retriable_error_code(error):
+    if isinstance(error, AgentStreamError):
+        code = error.code
+    elif isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+    elif isinstance(error, (ReadTimeoutError, EndpointConnectionError, ConnectionClosedError)):
+        return type(error).__name__.lower()
+    else:
+        return None
+    return code.lower() if code.lower() in retriable_error_codes else None
+
+
+# Client-side token bucket for invoke_agent calls whose rate adapts to throttling (AIMD): a throttle
+# multiplies the rate by `decrease`, and every successful call adds increase/rate, i.e. the rate grows
+# by about `increase` calls per second each second. Until the first throttle every success adds
+# `increase` itself, so the rate roughly doubles every second or two while the limit is unknown.
+# Throttles within one second of the last cut come from the same overload and do not cut again.
+# Also counts calls, retries and failures. One limiter is shared by all threads calling the agent.
+class AdaptiveRateLimiter:
+    def __init__(self, rate=1.0, min_rate=0.1, max_rate=50.0, increase=1.0, decrease=0.5, burst=1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_decrease = None
+        self.lock = threading.Lock()
+        self.started = None
+        self.calls = 0
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self.failures = 0
+
+    # Blocks until the bucket has a token for one call
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.started is None:
+                    self.started = now
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.calls += 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.successes += 1
+            step = self.increase if self.last_decrease is None else self.increase / self.rate
+            self.rate = min(self.max_rate, self.rate + step)
+
+    def on_throttle(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if self.last_decrease is None or now - self.last_decrease >= 1.0:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.tokens = min(self.tokens, 0)
+                self.last_decrease = now
+
+    def on_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    # Counters plus the achieved rate of successful calls since the first one
+    def stats(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started if self.started is not None else 0
+            return {'rate': self.rate, 'calls': self.calls, 'successes': self.successes, 'throttles': self.throttles,
+                    'retries': self.retries, 'failures': self.failures,
+                    'achieved_tps': self.successes / elapsed if elapsed > 0 else 0.0}
+
+
+# Runs call() until it succeeds, retrying retriable errors up to max_attempts times in total with
+# full-jitter exponential backoff, so throttled callers spread out instead of retrying in lockstep.
+# Each attempt first takes a token from rate_limiter, if given, and reports its outcome to it.
+def call_with_retries(call, rate_limiter=None, max_attempts=5, base_delay=0.5, max_delay=20.0):
+    for attempt in range(max_attempts):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            result = call()
+        except Exception as e:
+            code = retriable_error_code(e)
+            if code is None or attempt == max_attempts - 1:
+                if rate_limiter is not None:
+                    rate_limiter.on_failure()
+                raise
+            if rate_limiter is not None:
+                if code in throttling_error_codes:
+                    rate_limiter.on_throttle()
+                rate_limiter.on_retry()
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logger.info(f"invoke_agent failed with {code}, retrying in {delay:.2f} s (attempt {attempt + 2} of {max_attempts})")
+            time.sleep(delay)
+            continue
+        if rate_limiter is not None:
+            rate_limiter.on_success()
+        return result
+
+
 def pretty_print(df):
     return display(HTML( df.to_html().replace("\\n","<br>"))) # .replace("\\n","<p>") 
 
@@ -30,14 +242,12 @@ def format_final_response(question, final_answer, lab_number, turn_number, gen_s
     if gen_sql is True:
         
         generated_sql = list()
-        trace_file_name = f"trace_files/actionGroupInvocationOutput_lab{lab_number}_agent_trace_{turn_number}.log"
-        with open(trace_file_name, "r") as agent_trace_fp:
-            file_json = json.load(agent_trace_fp)
-            start_pos = str(file_json["text"]).index('SELECT')
-            end_pos = str(file_json["text"]).index(';')
-            #print(str(start_pos) + " >> " + str(end_pos))
-            generated_sql = str(file_json["text"])[start_pos:end_pos]
-            #print(gen_sql)
+        file_json = last_trace('actionGroupInvocationOutput', f"lab{lab_number}_agent_trace", turn_number)
+        start_pos = str(file_json["text"]).index('SELECT')
+        end_pos = str(file_json["text"]).index(';')
+        #print(str(start_pos) + " >> " + str(end_pos))
+        generated_sql = str(file_json["text"])[start_pos:end_pos]
+        #print(gen_sql)
 
 
         # Store and print as a dataframe
@@ -64,10 +274,134 @@ def invoke_agent_generate_response(bedrock_agent_runtime_client,
                                    enable_trace,
                                    end_session,
                                    trace_filename_prefix,
-                                   turn_number):
+                                   turn_number,
+                                   local_action_group=None,
+                                   rate_limiter=None,
+                                   max_attempts=5,
+                                   trace_compression=None,
+                                   trace_store=None):
 
-    # invoke the agent API
-    agentResponse = bedrock_agent_runtime_client.invoke_agent(
+    # with a return-control action group the agent stops at each API call; the call is run by
+    # local_action_group and its result is sent back to the agent until it answers. Throttled and
+    # other retriable calls are retried, paced by rate_limiter when one is given. All the trace events
+    # of the turn go to one TraceSink, closed when the turn ends, and from there to the trace store
+    # (trace_store.db unless another TraceStore is given).
+    session_state = None
+    with TraceSink(trace_filename_prefix, turn_number, compression=trace_compression,
+                   store=trace_store or open_trace_store(), session_id=session_id) as trace_sink:
+        while True:
+            final_answer, return_control = call_with_retries(
+                lambda: traced_attempt(trace_sink, lambda: invoke_agent_once(
+                    bedrock_agent_runtime_client, input_text, agent_id, agent_alias_id, session_id, enable_trace,
+                    end_session, trace_sink, session_state)),
+                rate_limiter, max_attempts)
+            if return_control is None:
+                return final_answer
+            session_state, _ = run_return_control(local_action_group, return_control, session_id, trace_sink)
+
+
+# Streaming variant of invoke_agent_generate_response(): a generator of typed events, each a dict with
+# 'type' and 'payload', yielded as they arrive instead of only the final answer at the end:
+#   chunk                        payload is the answer text
+#   preProcessingTrace, orchestrationTrace, knowledgeBaseLookupOutput, actionGroupInvocationOutput,
+#   postProcessingTrace          payload is that part of the trace, as in the trace widget
+#   guardrailTrace / guardrailIntervention
+#                                guardrail trace, the latter when the guardrail intervened
+#   trace                        any other trace event, payload is the whole event
+#   returnControl                the agent returned control; with a local_action_group its outputs
+#                                follow as actionGroupInvocationOutput events before the agent resumes
+# The caller can stop at any event, e.g. on the first guardrailIntervention; closing the generator
+# closes the response stream and ends the turn's trace. Calls that fail before their stream starts are
+# retried like in invoke_agent_generate_response(); errors in the middle of a stream are raised to the
+# caller, since its earlier events have already been yielded.
+def stream_agent_response(bedrock_agent_runtime_client,
+                          input_text,
+                          agent_id,
+                          agent_alias_id,
+                          session_id,
+                          enable_trace,
+                          end_session,
+                          trace_filename_prefix,
+                          turn_number,
+                          local_action_group=None,
+                          rate_limiter=None,
+                          max_attempts=5,
+                          trace_compression=None,
+                          trace_store=None):
+    session_state = None
+    with TraceSink(trace_filename_prefix, turn_number, compression=trace_compression,
+                   store=trace_store or open_trace_store(), session_id=session_id) as trace_sink:
+        while True:
+            event_stream = call_with_retries(
+                lambda: traced_attempt(trace_sink, lambda: open_agent_stream(
+                    bedrock_agent_runtime_client, input_text, agent_id, agent_alias_id, session_id, enable_trace,
+                    end_session, session_state)),
+                rate_limiter, max_attempts)
+            return_control = None
+            try:
+                for agent_event in agent_events(event_stream, trace_sink):
+                    if agent_event['type'] == 'returnControl':
+                        return_control = agent_event['payload']
+                    yield agent_event
+            finally:
+                close = getattr(event_stream, 'close', None)
+                if close is not None:
+                    close()
+            if return_control is None:
+                return
+            session_state, outputs = run_return_control(local_action_group, return_control, session_id, trace_sink)
+            for output in outputs:
+                yield {'type': 'actionGroupInvocationOutput', 'payload': output}
+
+
+# Runs one attempt of an invoke_agent call, marking it in the turn's trace so the events of a failed
+# attempt are not mixed into the turn when call_with_retries() runs it again
+def traced_attempt(trace_sink, call):
+    trace_sink.begin_attempt()
+    try:
+        return call()
+    except Exception as e:
+        trace_sink.fail_attempt(e)
+        raise
+
+
+# Runs the API calls of a returnControl event with local_action_group; returns the session state that
+# sends their results back to the agent, and their outputs in the shape of the actionGroupInvocationOutput trace
+def run_return_control(local_action_group, return_control, session_id, trace_sink):
+    if local_action_group is None:
+        raise Exception("agent returned control but no local_action_group was given", return_control)
+    results = []
+    outputs = []
+    for invocation_input in return_control['invocationInputs']:
+        api_result = local_action_group.invoke(invocation_input['apiInvocationInput'], session_id)
+        # same file and shape as the actionGroupInvocationOutput trace of a Lambda action group
+        output = {'text': api_result['responseBody']['application/json']['body']}
+        trace_sink.record('actionGroupInvocationOutput', output)
+        results.append({'apiResult': api_result})
+        outputs.append(output)
+    return {'invocationId': return_control['invocationId'], 'returnControlInvocationResults': results}, outputs
+
+
+# One invoke_agent call; returns the final answer and the returnControl payload, if the agent returned control
+def invoke_agent_once(bedrock_agent_runtime_client, input_text, agent_id, agent_alias_id, session_id, enable_trace,
+                      end_session, trace_sink, session_state=None):
+    event_stream = open_agent_stream(bedrock_agent_runtime_client, input_text, agent_id, agent_alias_id, session_id,
+                                     enable_trace, end_session, session_state)
+    final_answer = None
+    return_control = None
+    for agent_event in agent_events(event_stream, trace_sink):
+        if agent_event['type'] == 'chunk':
+            final_answer = agent_event['payload']
+            logger.info(f"Final answer ->\n{final_answer}")
+        elif agent_event['type'] == 'returnControl':
+            return_control = agent_event['payload']
+    return final_answer, return_control
+
+
+# Calls invoke_agent and returns its completion event stream
+def open_agent_stream(bedrock_agent_runtime_client, input_text, agent_id, agent_alias_id, session_id, enable_trace,
+                      end_session, session_state=None):
+    request = dict(
         inputText=input_text,
         agentId=agent_id,
         agentAliasId=agent_alias_id, 
@@ -75,56 +409,98 @@ def invoke_agent_generate_response(bedrock_agent_runtime_client,
         enableTrace=enable_trace, 
         endSession= end_session
     )
+    if session_state is not None:
+        # the agent ignores inputText when it receives the results of the calls it returned
+        request['sessionState'] = session_state
+
+    # invoke the agent API
+    agentResponse = bedrock_agent_runtime_client.invoke_agent(**request)
 
     #logger.info(pprint.pprint(agentResponse))
-    event_stream = agentResponse['completion']
-    final_answer = None
+    return agentResponse['completion']
+
+
+# Typed events of a completion stream (see stream_agent_response()); trace events also go to trace_sink
+def agent_events(event_stream, trace_sink):
     try:
         for event in event_stream:
             if 'chunk' in event:
                 data = event['chunk']['bytes']
-                final_answer = data.decode('utf8')
-                logger.info(f"Final answer ->\n{final_answer}") 
-                end_event_received = True
-                # End event indicates that the request finished successfully
+                yield {'type': 'chunk', 'payload': data.decode('utf8')}
             elif 'trace' in event:
-                #logger.info(json.dumps(event['trace'], indent=2))
-                with open("trace_files/full_trace_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "a") as agent_trace_fp:
-                    agent_trace_fp.writelines(json.dumps(event['trace'], indent=2))
-                   
-                logger.debug(f"entering if loop>>>> {type(event['trace'])} and keys ::: {event['trace']['trace'].keys()}")
-                # only save the last trace output for clear display
-                if 'preProcessingTrace' in event['trace']['trace']:
-                    logger.debug("saving pre-processing log")
-                    with open("trace_files/preProcessingTrace_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "w") as agent_trace_fp:
-                        agent_trace_fp.writelines(json.dumps(event['trace']['trace']['preProcessingTrace'], indent=2))
-
-                elif 'orchestrationTrace' in event['trace']['trace'] and 'observation' in event['trace']['trace']['orchestrationTrace'] and 'knowledgeBaseLookupOutput' in event['trace']['trace']['orchestrationTrace']['observation']:
-                    logger.debug("saving knowledgeBaseLookupOutput log")
-                    with open("trace_files/knowledgeBaseLookupOutput_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "w") as agent_trace_fp:
-                        agent_trace_fp.writelines(json.dumps(event['trace']['trace']['orchestrationTrace']['observation']['knowledgeBaseLookupOutput'], indent=2))
-                        
-                        
-                elif 'orchestrationTrace' in event['trace']['trace'] and 'observation' in event['trace']['trace']['orchestrationTrace'] and 'actionGroupInvocationOutput' in event['trace']['trace']['orchestrationTrace']['observation']:
-                    logger.debug("saving actionGroupInvocationOutput log")
-                    with open("trace_files/actionGroupInvocationOutput_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "w") as agent_trace_fp:
-                        agent_trace_fp.writelines(json.dumps(event['trace']['trace']['orchestrationTrace']['observation']['actionGroupInvocationOutput'], indent=2))
-                
-                elif 'guardrailTrace' in event['trace']['trace']:
-                    logger.debug("saving guardrailTrace log")
-                    with open("trace_files/guardrailTrace_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "w") as agent_trace_fp:
-                        agent_trace_fp.writelines(json.dumps(event['trace']['trace']['guardrailTrace'], indent=2))
-
-                elif 'orchestrationTrace' in event['trace']['trace']:
-                    logger.debug("saving orchestrationTrace log")
-                    with open("trace_files/orchestrationTrace_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "w") as agent_trace_fp:
-                        agent_trace_fp.writelines(json.dumps(event['trace']['trace']['orchestrationTrace'], indent=2))
+                # written by the sink's thread
+                trace_sink.write(event['trace'])
+                type_name, payload = trace_type(event['trace'].get('trace', {}))
+                if type_name is None:
+                    yield {'type': 'trace', 'payload': event['trace']}
+                    continue
+                if type_name == 'guardrailTrace' and payload.get('action') == 'INTERVENED':
+                    type_name = 'guardrailIntervention'
+                yield {'type': type_name, 'payload': payload}
+            elif 'returnControl' in event:
+                yield {'type': 'returnControl', 'payload': event['returnControl']}
+            elif len(event) == 1 and next(iter(event)).lower() in retriable_error_codes:
+                raise AgentStreamError(next(iter(event)), event)
             else:
                 raise Exception("unexpected event.", event)
                 
     except Exception as e:
+        if retriable_error_code(e) is not None:
+            raise  # left to call_with_retries
         raise Exception("unexpected event.", e)
 
-    return final_answer
 
 
+
+# Runs many agent invocations at once. jobs is a list of (input_text, session_id) pairs; at most
+# max_concurrency invocations are in flight, and the jobs of one session run one after the other in
+# their input order, since each turn builds on the previous one. Pass an AdaptiveRateLimiter to keep
+# the calls under the account's rate limit; its stats() report the achieved TPS and the retries. Job i writes its trace files as turn
+# i + 1. Returns one dict per job, in input order, with the final answer (or the error) and its timing.
+def invoke_agent_batch(bedrock_agent_runtime_client,
+                       jobs,
+                       agent_id,
+                       agent_alias_id,
+                       enable_trace=False,
+                       end_session=False,
+                       trace_filename_prefix='batch_agent_trace',
+                       max_concurrency=4,
+                       local_action_group=None,
+                       rate_limiter=None,
+                       max_attempts=5,
+                       trace_compression=None,
+                       trace_store=None):
+    results = [None] * len(jobs)
+    sessions = {}
+    for index, (input_text, session_id) in enumerate(jobs):
+        sessions.setdefault(session_id, []).append(index)
+    batch_start = time.perf_counter()
+
+    def run_session(indexes):
+        for index in indexes:
+            input_text, session_id = jobs[index]
+            result = {'input_text': input_text, 'session_id': session_id, 'final_answer': None, 'error': None,
+                      'started': time.perf_counter() - batch_start}
+            try:
+                result['final_answer'] = invoke_agent_generate_response(bedrock_agent_runtime_client, input_text,
+                                                                        agent_id, agent_alias_id, session_id,
+                                                                        enable_trace, end_session,
+                                                                        trace_filename_prefix, index + 1,
+                                                                        local_action_group=local_action_group,
+                                                                        rate_limiter=rate_limiter,
+                                                                        max_attempts=max_attempts,
+                                                                        trace_compression=trace_compression,
+                                                                        trace_store=trace_store)
+            except Exception as e:
+                # one failed invocation does not stop the batch; later turns of the session still run
+                logger.error(f"Job {index} of session {session_id} failed: {e}")
+                result['error'] = str(e)
+            result['seconds'] = time.perf_counter() - batch_start - result['started']
+            results[index] = result
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        for future in [executor.submit(run_session, indexes) for indexes in sessions.values()]:
+            future.result()
+    logger.info(f"Ran {len(jobs)} agent invocations in {len(sessions)} sessions in "
+                f"{time.perf_counter() - batch_start:.1f} s with up to {max_concurrency} at once")
+    return results
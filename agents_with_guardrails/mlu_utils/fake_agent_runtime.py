@@ -0,0 +1,99 @@
+import argparse
+import collections
+import random
+import sys
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+# Local stand-in for the bedrock-agent-runtime client, for exercising the batch invocation, rate
+# limiter and retries without an agent. invoke_agent() admits at most tps_limit calls in any one
+# second window and raises ThrottlingException beyond that, like the service; admitted calls take
+# `latency` seconds and stream back an answer. A fraction stream_error_rate of the admitted calls
+# fails mid-stream with a throttlingException event instead.
+class FakeAgentRuntime:
+    def __init__(self, tps_limit=5, latency=0.2, stream_error_rate=0.0, seed=1):
+        self.tps_limit = tps_limit
+        self.latency = latency
+        self.stream_error_rate = stream_error_rate
+        self.random = random.Random(seed)
+        self.admitted = collections.deque()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.stream_errors = 0
+
+    def invoke_agent(self, inputText, agentId, agentAliasId, sessionId, enableTrace=False, endSession=False,
+                     sessionState=None):
+        with self.lock:
+            self.calls += 1
+            now = time.monotonic()
+            while self.admitted and now - self.admitted[0] >= 1.0:
+                self.admitted.popleft()
+            if len(self.admitted) >= self.tps_limit:
+                self.throttled += 1
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'InvokeAgent')
+            self.admitted.append(now)
+            stream_error = self.random.random() < self.stream_error_rate
+            if stream_error:
+                self.stream_errors += 1
+        return {'completion': self.completion(inputText, stream_error)}
+
+    def completion(self, input_text, stream_error):
+        time.sleep(self.latency)
+        if stream_error:
+            yield {'throttlingException': {'message': 'Rate exceeded'}}
+            return
+        yield {'chunk': {'bytes': f'Answer to: {input_text}'.encode('utf8')}}
+
+
+# Runs a prompt sweep against the fake runtime with and without the adaptive limiter and prints the
+# wall clock, achieved TPS and retries of each. Exits non-zero unless every job of the limiter run was
+# answered and the limiter run was throttled less than the run with retries only.
+def main():
+    from mlu_utils.agents_utils import AdaptiveRateLimiter, invoke_agent_batch
+
+    parser = argparse.ArgumentParser(description='Prompt sweep against a throttling fake agent runtime')
+    parser.add_argument('--jobs', type=int, default=60)
+    parser.add_argument('--sessions', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--tps-limit', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--stream-error-rate', type=float, default=0.05)
+    args = parser.parse_args()
+
+    jobs = [(f'prompt {i}', f'session-{i % args.sessions}') for i in range(args.jobs)]
+    throttled = {}
+    failures = {}
+    for label, limiter in (('retries only', None), ('adaptive limiter', AdaptiveRateLimiter(rate=1.0))):
+        runtime = FakeAgentRuntime(args.tps_limit, args.latency, args.stream_error_rate)
+        start = time.perf_counter()
+        results = invoke_agent_batch(runtime, jobs, 'agent', 'alias', max_concurrency=args.concurrency,
+                                     rate_limiter=limiter, max_attempts=8)
+        elapsed = time.perf_counter() - start
+        failed = sum(1 for result in results if result['error'] is not None)
+        throttled[label] = runtime.throttled
+        failures[label] = failed
+        print(f'{label:<17} {elapsed:6.2f} s  {(len(jobs) - failed) / elapsed:5.2f} answers/s  failed {failed}  '
+              f'calls {runtime.calls}  throttled {runtime.throttled}  stream errors {runtime.stream_errors}')
+        if limiter is not None:
+            stats = limiter.stats()
+            print(f'{"":<17} limiter: rate {stats["rate"]:.2f}/s  achieved {stats["achieved_tps"]:.2f} TPS  '
+                  f'retries {stats["retries"]}  throttles {stats["throttles"]}  failures {stats["failures"]}')
+
+    problems = []
+    if failures['adaptive limiter']:
+        problems.append(f'{failures["adaptive limiter"]} jobs failed with the limiter')
+    if throttled['retries only'] and throttled['adaptive limiter'] >= throttled['retries only']:
+        problems.append(f'the limiter did not reduce throttling ({throttled["adaptive limiter"]} throttles, '
+                        f'{throttled["retries only"]} with retries only)')
+    if problems:
+        print('FAILED: ' + '; '.join(problems))
+        sys.exit(1)
+    print('OK: no failures with the limiter and fewer throttles than with retries only')
+
+
+if __name__ == '__main__':
+    main()
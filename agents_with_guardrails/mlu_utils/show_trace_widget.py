@@ -1,6 +1,7 @@
 import ipywidgets as widgets
 from IPython.display import JSON
 import logging
+from mlu_utils.trace_store import last_trace
 
 # action on tab click for agent trace
 out = widgets.Output(layout=widgets.Layout(border = '1px solid black', width = '100%',))
@@ -31,20 +32,15 @@ def click_button(obj):
         out.clear_output()
         logger.info(f'Expand JSON elements (if available) in {obj.new}')
         if obj.new == "Pre-Processing":
-             with open("trace_files/preProcessingTrace_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('preProcessingTrace', trace_filename_prefix, str(turn_number))))
         elif obj.new == "Orchestration":
-             with open("trace_files/orchestrationTrace_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('orchestrationTrace', trace_filename_prefix, str(turn_number))))
         elif obj.new == "Knowledge-Base":
-             with open("trace_files/knowledgeBaseLookupOutput_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('knowledgeBaseLookupOutput', trace_filename_prefix, str(turn_number))))
         elif obj.new == "Post-Processing":
-             with open("trace_files/postProcessingTrace_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('postProcessingTrace', trace_filename_prefix, str(turn_number))))
         elif obj.new == "ActionInvocation-Output":
-            with open("trace_files/actionGroupInvocationOutput_" + trace_filename_prefix + "_" + str(turn_number) + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('actionGroupInvocationOutput', trace_filename_prefix, str(turn_number))))
 
 
 def click_button_lab2a_turn1(obj):
@@ -53,20 +49,15 @@ def click_button_lab2a_turn1(obj):
         logger.info(f'Expand JSON elements (if available) in {obj.new}')
         
         if obj.new == "Pre-Processing":
-             with open("trace_files/preProcessingTrace_" + 'lab2a_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('preProcessingTrace', 'lab2a_agent_trace', '1')))
         elif obj.new == "Orchestration":
-             with open("trace_files/orchestrationTrace_" + 'lab2a_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('orchestrationTrace', 'lab2a_agent_trace', '1')))
         elif obj.new == "Knowledge-Base":
-             with open("trace_files/knowledgeBaseLookupOutput_" + 'lab2a_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('knowledgeBaseLookupOutput', 'lab2a_agent_trace', '1')))
         elif obj.new == "Post-Processing":
-             with open("trace_files/postProcessingTrace_" + 'lab2a_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('postProcessingTrace', 'lab2a_agent_trace', '1')))
         elif obj.new == "ActionInvocation-Output":
-            with open("trace_files/actionGroupInvocationOutput_" + 'lab2a_agent_trace' + "_" + str(turn_number) + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('actionGroupInvocationOutput', 'lab2a_agent_trace', str(turn_number))))
                 
 
 
@@ -76,20 +67,15 @@ def click_button_lab2a_turn2(obj):
         logger.info(f'Expand JSON elements (if available) in {obj.new}')
         
         if obj.new == "Pre-Processing":
-             with open("trace_files/preProcessingTrace_" + 'lab2a_agent_trace' + "_" + '2' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('preProcessingTrace', 'lab2a_agent_trace', '2')))
         elif obj.new == "Orchestration":
-             with open("trace_files/orchestrationTrace_" + 'lab2a_agent_trace' + "_" + '2' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('orchestrationTrace', 'lab2a_agent_trace', '2')))
         elif obj.new == "Knowledge-Base":
-             with open("trace_files/knowledgeBaseLookupOutput_" + 'lab2a_agent_trace' + "_" + '2' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('knowledgeBaseLookupOutput', 'lab2a_agent_trace', '2')))
         elif obj.new == "Post-Processing":
-             with open("trace_files/postProcessingTrace_" + 'lab2a_agent_trace' + "_" + '2' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('postProcessingTrace', 'lab2a_agent_trace', '2')))
         elif obj.new == "ActionInvocation-Output":
-            with open("trace_files/actionGroupInvocationOutput_" + 'lab2a_agent_trace' + "_" + '2' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('actionGroupInvocationOutput', 'lab2a_agent_trace', '2')))
 
 
 
@@ -99,20 +85,15 @@ def click_button_lab2a_turn3(obj):
         logger.info(f'Expand JSON elements (if available) in {obj.new}')
         
         if obj.new == "Pre-Processing":
-             with open("trace_files/preProcessingTrace_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('preProcessingTrace', 'lab2a_agent_trace', '3')))
         elif obj.new == "Orchestration":
-             with open("trace_files/orchestrationTrace_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('orchestrationTrace', 'lab2a_agent_trace', '3')))
         elif obj.new == "Knowledge-Base":
-             with open("trace_files/knowledgeBaseLookupOutput_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('knowledgeBaseLookupOutput', 'lab2a_agent_trace', '3')))
         elif obj.new == "Post-Processing":
-             with open("trace_files/postProcessingTrace_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('postProcessingTrace', 'lab2a_agent_trace', '3')))
         elif obj.new == "ActionInvocation-Output":
-            with open("trace_files/actionGroupInvocationOutput_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('actionGroupInvocationOutput', 'lab2a_agent_trace', '3')))
 
 
 def click_button_lab2a_turn4(obj):
@@ -121,23 +102,17 @@ def click_button_lab2a_turn4(obj):
         logger.info(f'Expand JSON elements (if available) in {obj.new}')
         
         if obj.new == "Pre-Processing":
-             with open("trace_files/preProcessingTrace_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('preProcessingTrace', 'lab2a_agent_trace', '3')))
         elif obj.new == "Orchestration":
-             with open("trace_files/orchestrationTrace_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('orchestrationTrace', 'lab2a_agent_trace', '3')))
         elif obj.new == "Knowledge-Base":
-             with open("trace_files/knowledgeBaseLookupOutput_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('knowledgeBaseLookupOutput', 'lab2a_agent_trace', '3')))
         elif obj.new == "Post-Processing":
-             with open("trace_files/postProcessingTrace_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('postProcessingTrace', 'lab2a_agent_trace', '3')))
         elif obj.new == "ActionInvocation-Output":
-            with open("trace_files/actionGroupInvocationOutput_" + 'lab2a_agent_trace' + "_" + '3' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('actionGroupInvocationOutput', 'lab2a_agent_trace', '3')))
         elif obj.new == "GuardRails":
-            with open("trace_files/guardrailTrace_" + 'lab2a_agent_trace' + "_" + '4' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('guardrailTrace', 'lab2a_agent_trace', '4')))
 
 
 
@@ -147,20 +122,15 @@ def click_button_lab2b_turn1(obj):
         logger.info(f'Expand JSON elements (if available) in {obj.new}')
         
         if obj.new == "Pre-Processing":
-             with open("trace_files/preProcessingTrace_" + 'lab2b_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('preProcessingTrace', 'lab2b_agent_trace', '1')))
         elif obj.new == "Orchestration":
-             with open("trace_files/orchestrationTrace_" + 'lab2b_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('orchestrationTrace', 'lab2b_agent_trace', '1')))
         elif obj.new == "Knowledge-Base":
-             with open("trace_files/knowledgeBaseLookupOutput_" + 'lab2b_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('knowledgeBaseLookupOutput', 'lab2b_agent_trace', '1')))
         elif obj.new == "Post-Processing":
-             with open("trace_files/postProcessingTrace_" + 'lab2b_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('postProcessingTrace', 'lab2b_agent_trace', '1')))
         elif obj.new == "ActionInvocation-Output":
-            with open("trace_files/actionGroupInvocationOutput_" + 'lab2b_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('actionGroupInvocationOutput', 'lab2b_agent_trace', '1')))
                 
 
 
@@ -170,20 +140,15 @@ def click_button_lab3_turn1(obj):
         logger.info(f'Expand JSON elements (if available) in {obj.new}')
         
         if obj.new == "Pre-Processing":
-             with open("trace_files/preProcessingTrace_" + 'lab3_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('preProcessingTrace', 'lab3_agent_trace', '1')))
         elif obj.new == "Orchestration":
-             with open("trace_files/orchestrationTrace_" + 'lab3_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('orchestrationTrace', 'lab3_agent_trace', '1')))
         elif obj.new == "Knowledge-Base":
-             with open("trace_files/knowledgeBaseLookupOutput_" + 'lab3_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('knowledgeBaseLookupOutput', 'lab3_agent_trace', '1')))
         elif obj.new == "Post-Processing":
-             with open("trace_files/postProcessingTrace_" + 'lab3_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+             display(JSON(last_trace('postProcessingTrace', 'lab3_agent_trace', '1')))
         elif obj.new == "ActionInvocation-Output":
-            with open("trace_files/actionGroupInvocationOutput_" + 'lab3_agent_trace' + "_" + '1' + ".log", "r") as agent_trace_fp:
-                display(JSON(agent_trace_fp.read()))
+            display(JSON(last_trace('actionGroupInvocationOutput', 'lab3_agent_trace', '1')))
 
 
 
@@ -3,6 +3,8 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_community.chat_models import BedrockChat
 from langchain_core.messages import HumanMessage
 import boto3
+import json
+from mlu_utils.trace_store import turn_trace_events
 
 MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
 bedrock_runtime_client = boto3.client("bedrock-runtime")
@@ -29,11 +31,9 @@ def test_llm_call(input_prompt):
 
 def summarize_agent_trace(trace_file_base_path= "trace_files/", lab_number="2b", turn_number="1"):
 
-    complete_log_path = trace_file_base_path + f"full_trace_lab{lab_number}_agent_trace_{turn_number}.log"
-    print(f">>>>>>>> complete_log_path to summarize==> {complete_log_path}")
-    trace_content_text = None
-    with open(complete_log_path, "r") as trace_fp:
-        trace_content_text = trace_fp.read().replace("\n", "")
+    print(f">>>>>>>> full trace to summarize==> lab{lab_number}_agent_trace turn {turn_number}")
+    trace_events = turn_trace_events(f"lab{lab_number}_agent_trace", turn_number, trace_file_base_path)
+    trace_content_text = "".join(json.dumps(trace_event, separators=(',', ':')) for trace_event in trace_events)
 
     # print(f"trace_content_text[:20] == {trace_content_text[:20]}")
     
@@ -0,0 +1,206 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logging.basicConfig(format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s', level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+# File name suffix of the full trace by compression
+trace_suffixes = {None: '.jsonl', 'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+
+# Trace types whose last event of a turn is also kept in its own file for the trace widget, in the order
+# they are looked for in an event: the observation outputs are more specific than the orchestration step
+def trace_type(trace):
+    if 'preProcessingTrace' in trace:
+        return 'preProcessingTrace', trace['preProcessingTrace']
+    observation = trace.get('orchestrationTrace', {}).get('observation', {})
+    if 'knowledgeBaseLookupOutput' in observation:
+        return 'knowledgeBaseLookupOutput', observation['knowledgeBaseLookupOutput']
+    if 'actionGroupInvocationOutput' in observation:
+        return 'actionGroupInvocationOutput', observation['actionGroupInvocationOutput']
+    if 'guardrailTrace' in trace:
+        return 'guardrailTrace', trace['guardrailTrace']
+    if 'orchestrationTrace' in trace:
+        return 'orchestrationTrace', trace['orchestrationTrace']
+    if 'postProcessingTrace' in trace:
+        return 'postProcessingTrace', trace['postProcessingTrace']
+    return None, None
+
+
+# Trace writer for one agent turn. Events handed to write() are queued and a writer thread encodes them
+# as compact JSON Lines into full_trace_<prefix>_<turn>.jsonl through one buffered handle (optionally
+# gzip or zstd compressed), so reading the completion stream never waits for the disk. When the turn
+# ends in close(), the events go to the TraceStore `store` in one transaction; without a store the last
+# event of each trace type is written once to <type>_<prefix>_<turn>.log instead.
+# Each invoke_agent call of the turn is an attempt: the full trace gets an {"attempt": n} line when one
+# starts and a {"failedAttempt": ...} line when it fails and is retried, and the store rows carry the
+# attempt number, with source 'failed' for the events of failed attempts. read_trace_events() and the
+# store queries leave failed attempts out.
+class TraceSink:
+    def __init__(self, trace_filename_prefix, turn_number, directory='trace_files', compression=None, store=None,
+                 session_id=None):
+        if compression not in trace_suffixes:
+            raise ValueError(f"compression must be one of {list(trace_suffixes)}, not {compression}")
+        if compression == 'zstd':
+            import zstandard  # optional, only needed for zstd traces; fail before the turn starts
+        self.trace_filename_prefix = trace_filename_prefix
+        self.turn_number = turn_number
+        self.directory = directory
+        self.compression = compression
+        self.path = full_trace_path(trace_filename_prefix, turn_number, directory, compression)
+        self.store = store
+        self.session_id = session_id
+        self.turn_id = store.new_turn_id() if store is not None else None
+        self.last = {}  # trace type -> last payload
+        self.rows = []  # for the store
+        self.attempt = 0
+        self.events = queue.SimpleQueue()
+        self.thread = None
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Queues one trace event (the 'trace' member of a completion stream event)
+    def write(self, trace_event):
+        self.put(None, trace_event)
+
+    # Keeps a payload as the last one of its type without adding it to the full trace, e.g. the output of
+    # an action group that ran on the client
+    def record(self, type_name, payload):
+        self.put(type_name, payload)
+
+    # Marks the start of an invoke_agent call
+    def begin_attempt(self):
+        self.put('attempt', None)
+
+    # Marks the current invoke_agent call as failed; its events stay in the full trace but are skipped by readers
+    def fail_attempt(self, error):
+        self.put('failedAttempt', str(error))
+
+    def put(self, type_name, payload):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='trace-sink', daemon=True)
+            self.thread.start()
+        self.events.put((type_name, payload, time.time()))
+
+    def run(self):
+        trace_fp = None
+        try:
+            while True:
+                item = self.events.get()
+                if item is None:
+                    break
+                type_name, trace_event, created = item
+                if type_name == 'attempt':
+                    self.attempt += 1
+                    trace_fp = self.write_line(trace_fp, {'attempt': self.attempt})
+                    continue
+                if type_name == 'failedAttempt':
+                    trace_fp = self.write_line(trace_fp, {'failedAttempt': {'attempt': self.attempt, 'error': trace_event}})
+                    self.rows = [row[:5] + ('failed',) + row[6:] if row[8] == self.attempt else row for row in self.rows]
+                    continue
+                if type_name is not None:
+                    self.last[type_name] = trace_event
+                    self.add_row(type_name, 'client', created, json.dumps(trace_event, separators=(',', ':')))
+                    continue
+                line = json.dumps(trace_event, separators=(',', ':'))
+                trace_fp = self.write_line(trace_fp, line)
+                type_name, payload = trace_type(trace_event.get('trace', {}))
+                if type_name is not None:
+                    self.last[type_name] = payload
+                self.add_row(type_name, 'agent', created, line)
+            if self.store is not None:
+                self.store.add(self.rows)
+        except Exception as e:
+            logger.error(f"Could not write trace {self.path}: {e}")
+            self.error = e
+        finally:
+            if trace_fp is not None:
+                trace_fp.close()
+
+    # Writes one line of the full trace, opening the file on the first one; returns the handle
+    def write_line(self, trace_fp, line):
+        if trace_fp is None:
+            trace_fp = self.open()
+        if not isinstance(line, str):
+            line = json.dumps(line, separators=(',', ':'))
+        trace_fp.write(line.encode('utf8') + b'\n')
+        return trace_fp
+
+    def add_row(self, type_name, source, created, event):
+        if self.store is not None:
+            self.rows.append((self.turn_id, self.session_id, self.trace_filename_prefix, self.turn_number, type_name,
+                              source, created, event, max(self.attempt, 1)))
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.compression == 'gzip':
+            return gzip.open(self.path, 'ab', compresslevel=6)
+        if self.compression == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor().stream_writer(open(self.path, 'ab'), closefd=True)
+        return open(self.path, 'ab', buffering=1024 * 1024)
+
+    # Ends the turn: waits for the queued events to be written, closes the file and, unless they went to
+    # the store, writes the last event of each type
+    def close(self):
+        if self.thread is not None:
+            self.events.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.store is not None and self.error is None:
+            self.last = {}
+            self.rows = []
+        if self.last:
+            os.makedirs(self.directory, exist_ok=True)
+        for type_name, payload in self.last.items():
+            with open(os.path.join(self.directory, f"{type_name}_{self.trace_filename_prefix}_{self.turn_number}.log"), "w") as agent_trace_fp:
+                agent_trace_fp.write(json.dumps(payload, indent=2))
+        self.last = {}
+
+
+def full_trace_path(trace_filename_prefix, turn_number, directory='trace_files', compression=None):
+    return os.path.join(directory, f"full_trace_{trace_filename_prefix}_{turn_number}{trace_suffixes[compression]}")
+
+
+# Returns the events of the full trace of a turn, whichever compression it was written with, without
+# the attempt markers and the events of failed attempts
+def read_trace_events(trace_filename_prefix, turn_number, directory='trace_files'):
+    for compression in trace_suffixes:
+        path = full_trace_path(trace_filename_prefix, turn_number, directory, compression)
+        if not os.path.exists(path):
+            continue
+        if compression == 'gzip':
+            with gzip.open(path, 'rb') as trace_fp:
+                data = trace_fp.read()
+        elif compression == 'zstd':
+            import zstandard
+            with open(path, 'rb') as trace_fp:
+                # re-running a turn appends another frame
+                data = zstandard.ZstdDecompressor().stream_reader(trace_fp, read_across_frames=True).read()
+        else:
+            with open(path, 'rb') as trace_fp:
+                data = trace_fp.read()
+        events = []
+        attempt_start = 0
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            trace_event = json.loads(line)
+            if 'attempt' in trace_event:
+                attempt_start = len(events)
+            elif 'failedAttempt' in trace_event:
+                del events[attempt_start:]
+            else:
+                events.append(trace_event)
+        return events
+    raise FileNotFoundError(f"no full trace for {trace_filename_prefix} turn {turn_number} in {directory}")
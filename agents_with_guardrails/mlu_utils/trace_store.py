@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from mlu_utils.trace_sink import read_trace_events, trace_type
+
+logging.basicConfig(format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s', level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+# Kept next to the notebooks rather than in trace_files/, which clean_up_trace_files() wipes on each run
+trace_store_path = 'trace_store.db'
+
+SQL_CREATE_TRACE_EVENTS = '''
+CREATE TABLE IF NOT EXISTS trace_events (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    turn_id TEXT NOT NULL,
+    session_id TEXT,
+    trace_filename_prefix TEXT NOT NULL,
+    turn_number TEXT NOT NULL,
+    event_type TEXT,
+    source TEXT NOT NULL,
+    created REAL NOT NULL,
+    event TEXT NOT NULL,
+    attempt INTEGER NOT NULL DEFAULT 1
+)'''
+
+SQL_CREATE_TRACE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS trace_events_by_turn ON trace_events (trace_filename_prefix, turn_number, event_type, id)',
+    'CREATE INDEX IF NOT EXISTS trace_events_by_turn_id ON trace_events (turn_id, id)',
+    'CREATE INDEX IF NOT EXISTS trace_events_by_turn_id_type ON trace_events (turn_id, event_type, id)',
+    'CREATE INDEX IF NOT EXISTS trace_events_by_session ON trace_events (session_id, turn_number)',
+    'CREATE INDEX IF NOT EXISTS trace_events_by_run ON trace_events (run_id)',
+]
+
+SQL_INSERT_TRACE_EVENT = '''
+INSERT INTO trace_events (run_id, turn_id, session_id, trace_filename_prefix, turn_number, event_type, source,
+                          created, event, attempt)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+
+# Trace events of every run, session and turn in one SQLite file. A TraceSink given a store adds the
+# events of its turn in one transaction when the turn ends; the widgets, the summarizer and
+# format_final_response() look them up by prefix and turn through the indexes instead of reading
+# trace_files/. Each execution of a turn gets its own turn_id, so re-running a turn does not mix its
+# events with the previous execution; queries for a prefix and turn return the latest one.
+class TraceStore:
+    def __init__(self, path=None, run_id=None):
+        self.path = path or trace_store_path
+        self.run_id = run_id or time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.lock:
+            self.conn.execute(SQL_CREATE_TRACE_EVENTS)
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(trace_events)')]
+            if 'attempt' not in columns:  # store created before attempts were recorded
+                self.conn.execute('ALTER TABLE trace_events ADD COLUMN attempt INTEGER NOT NULL DEFAULT 1')
+            for sql in SQL_CREATE_TRACE_INDEXES:
+                self.conn.execute(sql)
+
+    def new_turn_id(self):
+        return uuid.uuid4().hex
+
+    # rows are (turn_id, session_id, trace_filename_prefix, turn_number, event_type, source, created, event,
+    # attempt); source is 'agent', 'client' or 'failed'
+    def add(self, rows):
+        rows = [(self.run_id, turn_id, session_id, prefix, str(turn_number), event_type, source, created, event, attempt)
+                for turn_id, session_id, prefix, turn_number, event_type, source, created, event, attempt in rows]
+        if not rows:
+            return
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany(SQL_INSERT_TRACE_EVENT, rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # turn_id of the latest execution of a turn, or None
+    def latest_turn_id(self, trace_filename_prefix, turn_number):
+        rows = self.query('SELECT turn_id FROM trace_events WHERE trace_filename_prefix = ? AND turn_number = ? '
+                          'ORDER BY id DESC LIMIT 1', (trace_filename_prefix, str(turn_number)))
+        return rows[0][0] if rows else None
+
+    # Events the agent traced in the latest execution of a turn, in stream order
+    def events(self, trace_filename_prefix, turn_number):
+        turn_id = self.latest_turn_id(trace_filename_prefix, turn_number)
+        if turn_id is None:
+            return []
+        rows = self.query("SELECT event FROM trace_events WHERE turn_id = ? AND source = 'agent' ORDER BY id", (turn_id,))
+        return [json.loads(event) for event, in rows]
+
+    # Payload of the last event of a type in the latest execution of a turn (what the per-type trace file
+    # holds), or None when that execution has no such event
+    def last(self, trace_filename_prefix, turn_number, event_type):
+        turn_id = self.latest_turn_id(trace_filename_prefix, turn_number)
+        if turn_id is None:
+            return None
+        rows = self.query("SELECT source, event FROM trace_events WHERE turn_id = ? AND event_type = ? "
+                          "AND source != 'failed' ORDER BY id DESC LIMIT 1", (turn_id, event_type))
+        if not rows:
+            return None
+        source, event = rows[0]
+        if source != 'agent':
+            return json.loads(event)
+        return trace_type(json.loads(event).get('trace', {}))[1]
+
+    # One row per turn execution, oldest first: turn_id, run_id, session_id, prefix, turn number,
+    # start time, event count
+    def turns(self, run_id=None, session_id=None, trace_filename_prefix=None):
+        where, params = [], []
+        for column, value in (('run_id', run_id), ('session_id', session_id), ('trace_filename_prefix', trace_filename_prefix)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+        return self.query('SELECT turn_id, run_id, session_id, trace_filename_prefix, turn_number, MIN(created), COUNT(*) '
+                          'FROM trace_events ' + ('WHERE ' + ' AND '.join(where) + ' ' if where else '') +
+                          'GROUP BY turn_id ORDER BY MIN(id)', params)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+trace_stores = {}
+trace_stores_lock = threading.Lock()
+
+
+# Shared TraceStore for a path, so the writers and readers of one notebook kernel use one connection
+def open_trace_store(path=None):
+    path = path or trace_store_path
+    with trace_stores_lock:
+        if path not in trace_stores:
+            trace_stores[path] = TraceStore(path)
+        return trace_stores[path]
+
+
+# Events of a turn from the store, or from its full trace file when the store does not have the turn
+def turn_trace_events(trace_filename_prefix, turn_number, directory='trace_files', store=None):
+    store = store or open_trace_store()
+    events = store.events(trace_filename_prefix, turn_number)
+    if events:
+        return events
+    return read_trace_events(trace_filename_prefix, turn_number, directory)
+
+
+# Last payload of a type in the latest execution of a turn, from the store or, for turns the store does
+# not have, from the per-type trace file. Raises LookupError when that execution has no such event.
+def last_trace(event_type, trace_filename_prefix, turn_number, directory='trace_files', store=None):
+    store = store or open_trace_store()
+    if store.latest_turn_id(trace_filename_prefix, turn_number) is not None:
+        payload = store.last(trace_filename_prefix, turn_number, event_type)
+        if payload is None:
+            raise LookupError(f"no {event_type} trace in the latest run of {trace_filename_prefix} turn {turn_number}")
+        return payload
+    with open(os.path.join(directory, f"{event_type}_{trace_filename_prefix}_{turn_number}.log"), "r") as agent_trace_fp:
+        return json.load(agent_trace_fp)